@@ -0,0 +1,69 @@
+import json
+
+import pandas as pd
+from tqdm.auto import tqdm
+
+from evaluation import latency_percentiles, pair_metrics, timed_translate
+from translator import DECODING_PRESETS, Translator
+from utils import load_data_from_folder, processed_data
+
+# Model to benchmark (as in inference.py) and decoding presets compared
+model_path = "ea9all"
+tokenizer_path = "facebook/m2m100_418M"
+presets = list(DECODING_PRESETS)
+# Sentences translated together when measuring the latency (1 as in serving) and
+# sentences of each pair used (None for all of them)
+latency_batch_size = 1
+max_sentences = None
+# A preset is suggested for a pair when it loses at most this many points of
+# sacreBLEU and rougeL against the best preset of the pair
+max_metric_drop = 1.0
+report_path = "decoding_benchmark.json"
+
+# Load and process data
+test_data = processed_data(load_data_from_folder("test_data"))
+pairs = [
+    (src_lang, tgt_lang)
+    for src_lang, values in test_data.items()
+    for tgt_lang in values
+]
+
+translator = Translator(model_path, tokenizer_path, batch_size=latency_batch_size)
+
+# Translate every pair with every preset, measuring the latency of each batch
+report = []
+for src_lang, tgt_lang in tqdm(pairs):
+    data = test_data[src_lang][tgt_lang]
+    sentences = data.sources[:max_sentences]
+    for preset in presets:
+        predictions, latencies = timed_translate(
+            translator, sentences, src_lang, tgt_lang, latency_batch_size, preset=preset
+        )
+        report.append(
+            {
+                "pair": f"{src_lang}-{tgt_lang}",
+                "preset": preset,
+                "sentences": len(sentences),
+                **pair_metrics(data, predictions),
+                **latency_percentiles(latencies),
+                "seconds": sum(latencies),
+            }
+        )
+
+with open(report_path, "w") as f:
+    json.dump(report, f, indent=2)
+
+table = pd.DataFrame(report).set_index(["pair", "preset"])
+print(table[["sacrebleu", "rougeL", "p50", "p90", "p99", "seconds"]].round(2))
+
+# Fastest preset of each pair within max_metric_drop of its best metrics
+print("Suggested presets")
+for pair, rows in table.groupby(level="pair"):
+    rows = rows.droplevel("pair")
+    close = rows[
+        (rows["sacrebleu"] >= rows["sacrebleu"].max() - max_metric_drop)
+        & (rows["rougeL"] >= rows["rougeL"].max() - max_metric_drop)
+    ]
+    # No preset may be close to the best of both metrics at once
+    suggested = (close if len(close) else rows)["seconds"].idxmin()
+    print(f"{pair}: {suggested}")
@@ -0,0 +1,741 @@
+import hashlib
+import inspect
+import re
+import sqlite3
+
+# Compiled cleaning functions: the same ordered rules of utils.py, turned once into
+# a table of steps. Each step knows the characters it needs to fire, so a text that
+# cannot contain its pattern skips it without scanning. Consecutive literal rules
+# that cannot interact are merged and applied with a single multi-pattern scan.
+
+_LITERAL = 0
+_REGEX = 1
+_STRIP = 2
+
+
+# Two literal rules can be applied in the same scan if they can't overlap and the
+# first one can't create an occurrence of the second one (also joining the text
+# around a deletion)
+def _can_merge(first, second):
+    first_pattern, first_repl = first
+    second_pattern, _ = second
+    return (
+        not set(first_pattern) & set(second_pattern)
+        and not set(first_repl) & set(second_pattern)
+        and (first_repl != "" or len(second_pattern) == 1)
+    )
+
+
+def _replacer(mapping):
+    return lambda match: mapping[match.group()]
+
+
+class CompiledRules:
+    # Rules are ("literal", pattern, repl), ("regex", pattern, repl[, needed_chars]),
+    # ("group", trigger_chars, [regex rules]) or ("strip"/"lstrip", chars), applied
+    # in order like a chain of str.replace/re.sub. The regex rules of a group are
+    # all skipped when the text lacks the trigger characters.
+    def __init__(self, rules, max_plans=4096):
+        self.steps = []
+        self.max_plans = max_plans
+        self.plans = {}
+
+        group = []
+        for rule in rules:
+            if rule[0] == "literal":
+                if all(_can_merge(previous, rule[1:]) for previous in group):
+                    group.append(rule[1:])
+                    continue
+                self._add_literal_step(group)
+                group = [rule[1:]]
+                continue
+
+            self._add_literal_step(group)
+            group = []
+
+            if rule[0] == "regex":
+                self._add_regex_step(rule, "")
+            elif rule[0] == "group":
+                for regex_rule in rule[2]:
+                    if regex_rule[0] != "regex":
+                        raise ValueError("Only regex rules can be grouped")
+                    self._add_regex_step(regex_rule, rule[1])
+            elif rule[0] == "strip":
+                self.steps.append((_STRIP, str.strip, rule[1]))
+            elif rule[0] == "lstrip":
+                self.steps.append((_STRIP, str.lstrip, rule[1]))
+            else:
+                raise ValueError(f"Unknown rule kind `{rule[0]}`")
+
+        self._add_literal_step(group)
+
+    def _add_literal_step(self, group):
+        if group:
+            self.steps.append((_LITERAL, tuple(group)))
+
+    def _add_regex_step(self, rule, trigger):
+        needed_chars = frozenset(trigger + (rule[3] if len(rule) > 3 else ""))
+        # Characters the replacement can add, group references aside
+        added_chars = frozenset(re.sub(r"\\\d", "", rule[2]))
+        self.steps.append(
+            (_REGEX, re.compile(rule[1]), rule[2], needed_chars, added_chars)
+        )
+
+    # The operations that can fire on a text only depend on its characters: follow
+    # a superset of them through the steps (deletions never add characters)
+    def _make_plan(self, chars):
+        chars = set(chars)
+        plan = []
+
+        for step in self.steps:
+            if step[0] == _LITERAL:
+                active = [
+                    (pattern, repl)
+                    for pattern, repl in step[1]
+                    if chars.issuperset(pattern)
+                ]
+                if not active:
+                    continue
+
+                if len(active) == 1:
+                    plan.append((_LITERAL, active[0][0], active[0][1]))
+                else:
+                    regex = re.compile("|".join(re.escape(p) for p, _ in active))
+                    plan.append((_REGEX, regex, _replacer(dict(active))))
+
+                for pattern, repl in active:
+                    if len(pattern) == 1:
+                        chars.discard(pattern)
+                for pattern, repl in active:
+                    chars.update(repl)
+
+            elif step[0] == _REGEX:
+                if step[3] <= chars:
+                    plan.append(step[:3])
+                    chars.update(step[4])
+
+            else:
+                plan.append(step)
+
+        return plan
+
+    def __call__(self, text):
+        chars = frozenset(text)
+        plan = self.plans.get(chars)
+        if plan is None:
+            if len(self.plans) >= self.max_plans:
+                self.plans.clear()
+            plan = self._make_plan(chars)
+            self.plans[chars] = plan
+
+        for operation in plan:
+            if operation[0] == _LITERAL:
+                text = text.replace(operation[1], operation[2])
+            elif operation[0] == _REGEX:
+                text = operation[1].sub(operation[2], text)
+            else:
+                text = operation[1](text, operation[2])
+
+        return text
+
+
+# Hieroglyphs cleaning
+GRAPHICS_REJECT = re.compile(
+    "|".join(
+        re.escape(keyword)
+        for keyword in (
+            "{m1}〈S29〉",
+            "geschrieben",
+            "SandhiForm",
+            "Det.-von",
+            "erhalten",
+        )
+    )
+)
+
+GRAPHICS_RULES = [
+    # Comments
+    ("literal", '"sic"', ""),
+    ("literal", '"var"', ""),
+    ("literal", '"Var"', ""),
+    ("literal", '"var."', ""),
+    ("literal", "-var", ""),
+    ("literal", "-vae", ""),
+    ("literal", "-+lvar+s", ""),
+    ("literal", "-+linverted+s", ""),
+    ("literal", '"ein Vogel"', "/"),
+    ("literal", '"unleserliches Zeichen"', "/"),
+    ("literal", '"lb"', ""),
+    ("literal", '" lb"', ""),
+    ("literal", '"lb', ""),
+    ("literal", '"b"', ""),
+    ("literal", '"hierat"', ""),
+    ("literal", '"monogr"', ""),
+    ("literal", '"monogram"', ""),
+    ("literal", '"Spuren"', ""),
+    ("literal", '"large"', ""),
+    ("literal", '"hiero"', ""),
+    ("literal", '"mutil"', ""),
+    ("literal", '"composite"', ""),
+    ("literal", '"vacat"', ""),
+    ("literal", '"traces"', ""),
+    ("literal", '"senkrechte Zeichenspur"', ""),
+    ("literal", '"senkrechtes Zeichen"', ""),
+    # Jsesh graphic elements
+    ("literal", "**", "-"),
+    ("literal", "*", "-"),
+    ("literal", "//", "/"),
+    ("literal", "h/", "/"),
+    ("literal", "v/", "/"),
+    ("literal", "#b-/#e", "/"),
+    ("literal", "-:", "-"),
+    ("literal", ":", "-"),
+    ("literal", "[?", ""),
+    ("literal", "?]", ""),
+    ("literal", '"⸮"', ""),
+    ("literal", '"?"', ""),
+    ("literal", "\"'⸮'\"", ""),
+    ("literal", "\"'?'\"", ""),
+    ("literal", "[[", ""),
+    ("literal", "]]", ""),
+    ("literal", "[{*", ""),
+    ("literal", "*}]", ""),
+    ("literal", "[{-", ""),
+    ("literal", "-}]", ""),
+    ("literal", "[[*", ""),
+    ("literal", "*]]", ""),
+    ("literal", "[[-", ""),
+    ("literal", "-]]", ""),
+    ("literal", "[(-", ""),
+    ("literal", "-)]", ""),
+    ("literal", "(", ""),
+    ("literal", ")", ""),
+    ("literal", "$", ""),
+    ("literal", "<1-0>-", ""),
+    ("literal", "-<0-2>", ""),
+    ("literal", "<1-", ""),
+    ("literal", "-2>", ""),
+    ("literal", "-<1", ""),
+    ("literal", "<2-", ""),
+    ("literal", "-1>", ""),
+    ("literal", "<0-", ""),
+    ("literal", "-0>", ""),
+    ("literal", "<-", ""),
+    ("literal", "->", ""),
+    ("literal", "<", ""),
+    ("literal", ">", ""),
+    ("literal", '⸮"', ""),
+    ("literal", "##", ""),
+    ("literal", "v", ""),
+    # Specific phrase elements
+    ("literal", "ss", "S29"),
+    ("literal", "nn", "M22-M22"),
+    ("literal", '"lc"', ""),
+    ("literal", "prwn", "O1"),
+    ("literal", "rf", "D21-I9"),
+    ("literal", "ZeA", "Z2A"),
+    ("literal", "j", "M17"),
+    ("literal", "y1", "Y1"),
+    ("literal", "z2", "Z2"),
+    ("literal", "b1", "B1"),
+    ("literal", "pS", "F22"),
+    ("literal", "_", ""),
+    ("literal", '"⸮h"', ""),
+    ("literal", "!", ""),
+    # [& parenthesis and cleaning residues
+    ("literal", '"', ""),
+    ("literal", "[&", ""),
+    ("literal", "&]", ""),
+    ("literal", "&", "-"),
+    ("regex", r"-+", "-", "-"),
+    ("literal", "- ", " "),
+    ("literal", " -", " "),
+    ("strip", "-"),
+    # \\Rx, cartouche, \\, space at end and beginning
+    ("regex", r"\\\\R.*?(-|\s|$)", r"\1", "\\R"),
+    ("regex", r"\\\\.*?(-|\s|$)", r"\1", "\\"),
+    ("regex", r"\\.*?(-|\s|$)", r"\1", "\\"),
+    ("regex", r"\((.*?)\)\|", r"\1", "()|"),
+    ("literal", "\\", ""),
+    ("strip", None),
+    # Double spaces again and -
+    ("literal", "-", " "),
+]
+
+_clean_graphics = CompiledRules(GRAPHICS_RULES)
+
+
+def clean_graphics(text: str) -> str:
+    # Start from double spaces and sentences to delete
+    text = " ".join(text.split())
+    if text == "//" or GRAPHICS_REJECT.search(text):
+        return ""
+
+    text = _clean_graphics(text)
+    return " ".join(text.split())
+
+
+# Traduction cleaning
+TRADUCTION_REJECT = re.compile(
+    "|".join(
+        re.escape(keyword)
+        for keyword in (
+            "-??-",
+            "--",
+            "...",
+            "…",
+            ". . .",
+            "_",
+            "?_?",
+            "keine Übersetzung vorhanden",
+            "Keine Übersetzung möglich",
+        )
+    )
+)
+
+TRADUCTION_EQUALS = re.compile(r"\(=.*?\)")
+
+TRADUCTION_RULES = [
+    # lhg acronym, other languages, special parenthesis and chapter numbers
+    ("regex", r"\(\((.*?)\)\)", r"\1", "()"),
+    ("regex", r"\[\[(.*?)\]\]", r"\1", "[]"),
+    ("literal", '"arbustes à épines"', "dornige Sträucher"),
+    ("literal", "rôdeurs", "plünderer"),
+    ("regex", '\\"(.*?)"', r"\1", '"'),
+    ("regex", r"(\/[\w+ÄäÖöẞßÜü]+)", " ", "/"),
+    ("literal", "- LHG -", " Leben, Heil, Gesundheit "),
+    ("literal", "- LHG", " Leben, Heil, Gesundheit "),
+    ("literal", "-LHG", " Leben, Heil, Gesundheit "),
+    ("literal", "- {LHG} LHG -", " Leben, Heil, Gesundheit "),
+    ("literal", "LHG", "Leben, Heil, Gesundheit"),
+    ("literal", "l.h.g.", "Leben, Heil, Gesundheit"),
+    ("literal", "l.h,.g.", "Leben, Heil, Gesundheit"),
+    ("literal", "l.h-g", "Leben, Heil, Gesundheit"),
+    ("literal", "l.h.g .", "Leben, Heil, Gesundheit"),
+    ("literal", "l.h.g -", "Leben, Heil, Gesundheit"),
+    ("literal", "l.h.g", "Leben, Heil, Gesundheit"),
+    ("literal", "l.p.h.", "Life, Prosperity, Health"),
+    ("literal", "LPH", "Life, Prosperity, Health"),
+    ("literal", "„", ""),
+    ("literal", "“", ""),
+    ("literal", "”", ""),
+    ("literal", "⸢", ""),
+    ("literal", "⸣", ""),
+    ("regex", r"\$\[.*?\]\$", "", "$[]"),
+    ("literal", "[", ""),
+    ("literal", "]", ""),
+    ("literal", "<", ""),
+    ("literal", ">", ""),
+    ("literal", "𓉘", ""),
+    ("literal", "𓊂", ""),
+    ("literal", "𓍹", ""),
+    ("literal", "𓍺", ""),
+    ("literal", "‚", ""),
+    ("literal", "‘", ""),
+    ("regex", r"⸮(.*?)\?", r"\1", "⸮?"),
+    # text = re.sub('\((.*?)\)[^\|]', ' ', text) !Attention! Problems with other parenthesis
+    ("regex", r"\((.*?)\)\|", r"\1", "()|"),
+    ("literal", "|", ""),
+    (
+        "group",
+        "§",
+        [
+            ("regex", r"\[§[0-9]+\]", ""),
+            ("regex", r"\[§[0-9]+\w+\]", ""),
+            ("regex", r"§[0-9]+(\s|\.|$|\,|\:|.*?)", r"\1"),
+            ("regex", r"§\s[0-9]+(\s|\.|$|\,|\:|.*?)", r"\1"),
+            ("regex", r"§\s[0-9]+-[0-9]+(\s|\.|$|\,|\:|.*?)", r"\1"),
+        ],
+    ),
+    ("regex", r"\-\s(Variante)(.*?)\-", "", "-Variante"),
+    ("regex", r"^(Variante)(.*?)$", r"\2", "Variante"),
+    ("regex", r"(Variante)(.*?)$", "", "Variante"),
+    # und, von, OA, UA acronyms and comments inside parenthesis
+    ("literal", "u.", "und"),
+    ("literal", "v.", "von"),
+    ("literal", ". ---", ""),
+    ("literal", "--NN--", ""),
+    ("literal", "|NN|", ""),
+    ("literal", "NN", ""),
+    ("regex", r"\(wört.*?\)", "", "(wört)"),
+    ("regex", r"\(wört.*?$", "", "(wört"),
+    ("regex", r"\[ältere Fassung.*?\]", "", "[ältere Fassung]"),
+    ("regex", r"\(älterer Text.*?\)", "", "(älterer Text)"),
+    ("regex", r"\(oder.*?\)", "", "(oder)"),
+    ("regex", r"^\[Beischrift.*?\]:", "", "[Beischrift]:"),
+    ("regex", r"\[Beischrift.*?\]", "", "[Beischrift]"),
+    ("regex", r"\[.*?Beischrift.*?\]", "", "[Beischrift]"),
+    ("regex", r"(O.?Äg?\.?)", "Oberägypten", "OÄ"),
+    ("regex", r"(U.?Äg?\.?)", "Unterägypten", "UÄ"),
+    ("strip", "'"),
+    ("strip", '"'),
+    ("strip", None),
+    ("lstrip", "."),
+    # 〈〉 and {} parenthesis, and other elements
+    (
+        "group",
+        "〈〉{}",
+        [
+            ("regex", r"\{(.*?)\}\〈(.*?)\〉", r"\1"),
+            ("regex", r"\〈(.*?)\〉\{(.*?)\}", r"\2"),
+        ],
+    ),
+    ("literal", "〈〈", ""),
+    ("literal", "〉〉", ""),
+    ("literal", "{{", ""),
+    ("literal", "}}", ""),
+    (
+        "group",
+        "〈〉{}",
+        [
+            ("regex", r"(\{.*?\}\s+[\wÄäÖöẞßÜü.,=:]+\s+)\〈(.*?)\〉", r"\1"),
+            ("regex", r"\〈(.*?)\〉(\s+[\wÄäÖöẞßÜü.,=:]+\s+\{.*?\})", r"\2"),
+            (
+                "regex",
+                r"(\{.*?\}[\wÄäÖöẞßÜü.,=:]+\s+[\wÄäÖöẞßÜü.,=:]+\s+)\〈(.*?)\〉",
+                r"\1",
+            ),
+            (
+                "regex",
+                r"\〈(.*?)\〉([\wÄäÖöẞßÜü.,=:]+\s+[\wÄäÖöẞßÜü.,=:]+\s+\{.*?\})",
+                r"\2",
+            ),
+            (
+                "regex",
+                r"(\{.*?\}\s+[\wÄäÖöẞßÜü.,=:]+\s+[\wÄäÖöẞßÜü.,=:]+\s+)\〈(.*?)\〉",
+                r"\1",
+            ),
+            (
+                "regex",
+                r"\〈(.*?)\〉(\s+[\wÄäÖöẞßÜü.,=:]+\s+[\wÄäÖöẞßÜü.,=:]+\s+\{.*?\})",
+                r"\2",
+            ),
+            ("regex", r"\〈(.*?)\〉(\s+[\wÄäÖöẞßÜü.,=:]+\{.*?\})", r"\2"),
+            ("regex", r"(\{.*?\}[\wÄäÖöẞßÜü.,=:]+\s+)\〈(.*?)\〉", r"\1"),
+            ("regex", r"\〈(.*?)\〉([\wÄäÖöẞßÜü.,=:]+\s+\{.*?\})", r"\2"),
+            ("regex", r"\{(.*?)\}\s\〈(.*?)\〉", r"\1"),
+            ("regex", r"\〈(.*?)\〉\s\{(.*?)\}", r"\2"),
+        ],
+    ),
+    ("regex", r'"(.*?)\/(.*?)"', r"\1", '"/'),
+    ("literal", "〈", ""),
+    ("literal", "〉", ""),
+    ("literal", "{", ""),
+    ("literal", "}", ""),
+    ("literal", "Ꜥ", "ꜥ"),
+    ("literal", "`", "'"),
+    ("literal", "#", ""),
+    ("literal", "≡", "="),
+    ("literal", "&", "und"),
+    ("literal", "$", ""),
+    ("literal", "(?)", ""),
+    ("regex", r"\.\s(oder[\s\wÄäÖöẞßÜü.,=:]+)", "", ".oder"),
+    ("literal", "*", ""),
+    ("literal", '"', ""),
+    ("regex", r"\(.*?\)", "", "()"),
+    ("regex", r"\(d\.h\.\s[\s\wÄäÖöẞßÜü.,=:]+", "", "(d.h"),
+]
+
+_clean_traduction = CompiledRules(TRADUCTION_RULES)
+
+
+def clean_traduction(text):
+    # Start from double spaces and sentences to delete
+    text = " ".join(text.split())
+    if text.endswith("..."):
+        text = text[:-3].strip()
+    # Any "--" survives the --zerstört-- substitution, so it's enough to reject it
+    if text == "?" or TRADUCTION_REJECT.search(text):
+        return ""
+    if "(=" in text:
+        text = TRADUCTION_EQUALS.sub("", text)
+        if "[---]" in text:
+            return ""
+
+    text = _clean_traduction(text)
+    # Double spaces again
+    return " ".join(text.split())
+
+
+# Transliteration cleaning
+WCHAR_REJECT = re.compile(r"\.\.\.|_|-\?\?-")
+
+WCHAR_RULES = [
+    # (()), [[]], ⸮? parenthesis, and two elements
+    ("regex", r"\(\((.*?)\)\)", r"\1", "()"),
+    ("regex", r"\[\[(.*?)\]\]", r"\1", "[]"),
+    ("literal", "⸮", ""),
+    ("literal", "?", ""),
+    ("literal", "~", ""),
+    ("literal", ".pl.", ""),
+    ("literal", ".pl", ""),
+    ("literal", ".{pl}", ""),
+    ("literal", "{.pl}", ""),
+    ("literal", ",pl", ""),
+    ("literal", ".Pl", ""),
+    ("literal", "pl", ""),
+    # text = text.replace('{(ꜥnḫ-wḏꜣ-snb)} ꜥnḫ', 'ꜥnḫ')
+    ("literal", "[", ""),
+    ("literal", "]", ""),
+    ("literal", "-(Zahl)-", ""),
+    ("literal", "oder ḫr =s", ""),
+    ("literal", "ON", ""),
+    ("literal", "GN", ""),
+    ("literal", "a", ""),
+    ("literal", "Zahl", ""),
+    ("literal", "(", ""),
+    ("literal", ")", ""),
+    ("literal", "⸢", ""),
+    ("literal", "⸣", ""),
+    ("literal", "..1Q..", "/"),
+    ("literal", "..2Q..", "/ /"),
+    # Inside 〈〉 and {} parenthesis
+    (
+        "group",
+        "〈〉{}",
+        [
+            (
+                "regex",
+                r"(\〈[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\〉.*?\〈[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\〉)(.*?\{[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\}.*?\{[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\})",
+                r"\2",
+            ),
+            ("regex", r"(\{.*?\}\s\{.*?\})\s(\〈.*?\〉\s\〈.*?\〉)", r"\1"),
+            ("regex", r"(\〈.*?\〉\s\〈.*?\〉)\s(\{.*?\}\s\{.*?\})", r"\2"),
+            ("regex", r"(\{.*?\}\s\{.*?\})\s\〈(.*?)\〉", r"\1"),
+            ("regex", r"\〈(.*?)\〉\s(\{.*?\}\s\{.*?\})", r"\2"),
+            ("regex", r"(\{.*?\})\s(\〈.*?\〉\s\〈.*?\〉)", r"\2"),
+            ("regex", r"(\〈.*?\〉\s\〈.*?\〉)\s(\{.*?\})", r"\1"),
+            ("regex", r"(\{.*?\}\s.*?\s\{.*?\})\s(\〈.*?\〉)", r"\1"),
+            ("regex", r"(\〈.*?\〉\s.*?\s\〈.*?\〉)\s(\{.*?\})", r"\1"),
+            ("regex", r"\{(.*?)\}[^\s]\〈(.*?)\〉", r"\1"),
+            ("regex", r"\〈(.*?)\〉[^\s]\{(.*?)\}", r"\2"),
+            ("regex", r"\{(.*?)\}\s[^\s]\〈(.*?)\〉", r"\1"),
+            ("regex", r"\〈(.*?)\〉\s[^\s]\{(.*?)\}", r"\2"),
+            ("regex", r"(\{.*?\}[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+)\〈(.*?)\〉", r"\1"),
+            ("regex", r"(\〈.*?\〉)([a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\{.*?\})", r"\2"),
+            ("regex", r"(\{.*?\}\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+)\〈(.*?)\〉", r"\1"),
+            ("regex", r"(\〈.*?\〉)(\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\{.*?\})", r"\2"),
+            ("regex", r"(\{.*?\}\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s)\〈(.*?)\〉", r"\1"),
+            ("regex", r"(\〈.*?\〉)(\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s\{.*?\})", r"\2"),
+            ("regex", r"(\{.*?\}[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s)\〈(.*?)\〉", r"\1"),
+            ("regex", r"(\〈.*?\〉)([a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s\{.*?\})", r"\2"),
+            (
+                "regex",
+                r"(\{.*?\}\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+)\〈(.*?)\〉",
+                r"\1",
+            ),
+            (
+                "regex",
+                r"(\〈.*?\〉)(\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\{.*?\})",
+                r"\2",
+            ),
+            (
+                "regex",
+                r"(\{.*?\}[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+)\〈(.*?)\〉",
+                r"\1",
+            ),
+            (
+                "regex",
+                r"(\〈.*?\〉)([a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\{.*?\})",
+                r"\2",
+            ),
+            (
+                "regex",
+                r"(\{.*?\}[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s)\〈(.*?)\〉",
+                r"\1",
+            ),
+            (
+                "regex",
+                r"(\〈.*?\〉)([a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s\{.*?\})",
+                r"\2",
+            ),
+            (
+                "regex",
+                r"(\{.*?\}[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s)\〈(.*?)\〉",
+                r"\1",
+            ),
+            (
+                "regex",
+                r"\〈(.*?)\〉(\{.*?\}[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s)",
+                r"\2",
+            ),
+            (
+                "regex",
+                r"(\{.*?\}\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s)\〈(.*?)\〉",
+                r"\1",
+            ),
+            (
+                "regex",
+                r"(\〈.*?\〉)(\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s\{.*?\})",
+                r"\2",
+            ),
+            (
+                "regex",
+                r"(\{.*?\}\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+)\〈(.*?)\〉",
+                r"\1",
+            ),
+            (
+                "regex",
+                r"(\〈.*?\〉)(\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\{.*?\})",
+                r"\2",
+            ),
+            (
+                "regex",
+                r"(\{.*?\}\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s)\〈(.*?)\〉",
+                r"\1",
+            ),
+            (
+                "regex",
+                r"\〈(.*?)\〉(\{.*?\}\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s[a-zA-Z0-9ḤḥḪḫẖꜣꜥḏṯš.,:=i̯]+\s)",
+                r"\2",
+            ),
+            ("regex", r"\{(.*?)\}\〈(.*?)\〉", r"\1"),
+            ("regex", r"\〈(.*?)\〉\-\{(.*?)\}", r"\2"),
+            ("regex", r"\{(.*?)\}\\-〈(.*?)\〉", r"\1"),
+            ("regex", r"\〈(.*?)\〉\s\{(.*?)\}", r"\2"),
+            ("regex", r"\{(.*?)\}\s\〈(.*?)\〉", r"\1"),
+            ("regex", r"\〈(.*?)\〉\{(.*?)\}", r"\2"),
+        ],
+    ),
+    # # Fractions
+    # text = re.sub('\〈\w+\/\w+\〉\s\〈\w+\/\w+\〉\s.*?(\{\w+\/\w+\}\s\{\w+\/\w+\})', r'\1', text)
+    # 〈〉 and {} parenthesis and other elements
+    ("literal", "〈", ""),
+    ("literal", "〉", ""),
+    ("literal", "{", ""),
+    ("literal", "}", ""),
+    ("literal", ":", ""),
+    ("literal", ".du", ""),
+    ("literal", ",du", ""),
+    ("literal", "≡", "="),
+    ("literal", "-Lücke-", ""),
+    ("literal", "Lücke", ""),
+    ("literal", "-", " "),
+    ("literal", "+", ""),
+    ("literal", "!", ""),
+    ("literal", "ø", ""),
+    ("literal", "𓍹", ""),
+    ("literal", "𓍺", ""),
+    ("literal", "⁝", ""),
+    ("literal", "Präp.", ""),
+    ("literal", "𓊆", ""),
+    ("literal", "𓊇", ""),
+    # text = text.replace('ð', '')
+    # text = text.replace('ṯb;w,t', 'ṯbw,t')
+    ("literal", "t'", "tꜥ"),
+    ("literal", "jmj-r'", "jmj-rꜥ"),
+    ("literal", "ʾ", "ꜥ"),
+    ("strip", None),
+    # Double spaces again
+]
+
+_clean_wChar = CompiledRules(WCHAR_RULES)
+
+
+def clean_wChar(text):
+    # Start from double spaces and sentences to delete
+    text = " ".join(text.split())
+    if WCHAR_REJECT.search(text):
+        return ""
+
+    text = _clean_wChar(text)
+    # Double spaces again
+    return " ".join(text.split())
+
+
+cleaners = {
+    "graphics": clean_graphics,
+    "wChar": clean_wChar,
+    "traduction": clean_traduction,
+}
+
+
+# Changes whenever a rule, a rejection check or the engine changes
+def rules_fingerprint():
+    digest = hashlib.sha256()
+    for rules in (GRAPHICS_RULES, TRADUCTION_RULES, WCHAR_RULES):
+        digest.update(repr(rules).encode())
+    for regex in (GRAPHICS_REJECT, TRADUCTION_REJECT, TRADUCTION_EQUALS, WCHAR_REJECT):
+        digest.update(regex.pattern.encode())
+    for code in (CompiledRules, clean_graphics, clean_traduction, clean_wChar):
+        digest.update(inspect.getsource(code).encode())
+    return digest.hexdigest()
+
+
+# Persistent cache of cleaned texts: entries are addressed by the hash of the cleaner
+# kind, the rules fingerprint and the raw text, and the least recently used ones
+# are evicted beyond max_entries
+class CleaningCache:
+    def __init__(self, path, max_entries=5_000_000, fingerprint=None):
+        self.max_entries = max_entries
+        self.fingerprint = fingerprint or rules_fingerprint()
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cleaned "
+            "(key BLOB PRIMARY KEY, value TEXT NOT NULL, used INTEGER NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS cleaned_used ON cleaned (used)"
+        )
+        self.clock = self.connection.execute(
+            "SELECT COALESCE(MAX(used), 0) FROM cleaned"
+        ).fetchone()[0]
+
+    def key(self, kind, text):
+        return hashlib.sha256(f"{kind}\0{self.fingerprint}\0{text}".encode()).digest()
+
+    # Dict of the cached (kind, text) -> cleaned text among the requested ones
+    def get_many(self, items, query_size=500):
+        keys = {self.key(kind, text): (kind, text) for kind, text in set(items)}
+        key_list = list(keys)
+        found = {}
+
+        for i in range(0, len(key_list), query_size):
+            batch = key_list[i : i + query_size]
+            rows = self.connection.execute(
+                "SELECT key, value FROM cleaned WHERE key IN "
+                f"({','.join('?' * len(batch))})",
+                batch,
+            )
+            for key, value in rows:
+                found[keys[key]] = value
+
+        self.clock += 1
+        self.connection.executemany(
+            "UPDATE cleaned SET used = ? WHERE key = ?",
+            [(self.clock, self.key(kind, text)) for kind, text in found],
+        )
+        self.connection.commit()
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    # items are ((kind, text), cleaned text) pairs
+    def put_many(self, items):
+        self.clock += 1
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO cleaned (key, value, used) VALUES (?, ?, ?)",
+            [
+                (self.key(kind, text), value, self.clock)
+                for (kind, text), value in items
+            ],
+        )
+
+        excess = len(self) - self.max_entries
+        if excess > 0:
+            self.connection.execute(
+                "DELETE FROM cleaned WHERE key IN "
+                "(SELECT key FROM cleaned ORDER BY used LIMIT ?)",
+                (excess,),
+            )
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM cleaned").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
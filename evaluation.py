@@ -0,0 +1,51 @@
+import string
+import time
+
+import datasets
+import numpy as np
+
+from utils import batch_it
+
+
+# sacreBLEU and rougeL (x100) of the predictions of one language pair against the
+# targets of its data, comparing lowercased words without surrounding punctuation
+def pair_metrics(data, predictions):
+    metrics = {m: datasets.load_metric(m) for m in ("sacrebleu", "rouge")}
+    for element, prediction in zip(data, predictions):
+        for metric in metrics.values():
+            metric.add_batch(
+                predictions=[prediction.strip(string.punctuation).lower().split()],
+                references=[
+                    [element["target"].strip(string.punctuation).lower().split()]
+                ],
+            )
+
+    return {
+        "sacrebleu": metrics["sacrebleu"].compute()["score"],
+        "rougeL": 100 * metrics["rouge"].compute()["rougeL"].mid.fmeasure,
+    }
+
+
+# Translations of the sentences, batch_size sentences at a time (in their order),
+# and the seconds taken by each batch
+def timed_translate(
+    translator, sentences, src_lang, tgt_lang, batch_size=1, **generate_kwargs
+):
+    translations = []
+    latencies = []
+    for batch in batch_it(sentences, batch_size):
+        start = time.perf_counter()
+        translations += translator.translate(
+            batch, src_lang, tgt_lang, batch_size=batch_size, **generate_kwargs
+        )
+        latencies.append(time.perf_counter() - start)
+
+    return translations, latencies
+
+
+# Percentiles of the latencies, in milliseconds
+def latency_percentiles(latencies, percentiles=(50, 90, 99)):
+    return {
+        f"p{p}": 1000 * value
+        for p, value in zip(percentiles, np.percentile(latencies, percentiles))
+    }
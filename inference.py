@@ -1,92 +1,65 @@
-import string
-
-import datasets
 import pandas as pd
-import torch
 from tqdm.auto import tqdm
-from transformers import M2M100ForConditionalGeneration, M2M100Tokenizer
 
-from utils import lang_to_m2m_lang_id, load_data_from_folder, processed_data
+from evaluation import pair_metrics
+from translator import Translator
+from utils import load_data_from_folder, processed_data
 
 # Load data
 test_data = load_data_from_folder("test_data")
 
 # Filter and extract data
-# Dict[str, Dict[str, List[Dict[str, str]]]]
-# {src_lang: {tgt_lang: [{'source': ..., 'target': ...}]}}
+# Dict[str, Dict[str, PairData]]
+# {src_lang: {tgt_lang: [{'source': ..., 'target': ..., 'metadata': ...}]}}
 test_data = processed_data(test_data)
 
 
-# Load model to generate predictions
-model = M2M100ForConditionalGeneration.from_pretrained("ea9all").to("cuda:0").eval()
-tokenizer = M2M100Tokenizer.from_pretrained("facebook/m2m100_418M")
+# Load model to generate predictions, translating generation_batch_size sentences
+# together (sorted by length within each pair). With quantize, the model runs on
+# the cpu with int8 linear layers. The decoding presets are in
+# translator.DECODING_PRESETS
+generation_batch_size = 32
+quantize = False
+translator = Translator(
+    "ea9all",
+    "facebook/m2m100_418M",
+    batch_size=generation_batch_size,
+    quantize=quantize,
+    preset="full_beam",
+)
 
 # Produce predictions
-for src_lang, values in test_data.items():
-    for tgt_lang, data in values.items():
-        for element in tqdm(data):
-            with torch.no_grad():
-                with torch.cuda.amp.autocast():
-                    tokenizer.src_lang = lang_to_m2m_lang_id[src_lang]
-                    tokenizer.tgt_lang = lang_to_m2m_lang_id[tgt_lang]
-
-                    model_inputs = tokenizer(
-                        [element["source"]], return_tensors="pt"
-                    ).to(model.device)
-                    generated_tokens = model.generate(
-                        **model_inputs,
-                        num_beams=10,
-                        forced_bos_token_id=tokenizer.get_lang_id(
-                            lang_to_m2m_lang_id[tgt_lang]
-                        )
-                    )
-                    element["prediction"] = tokenizer.batch_decode(
-                        generated_tokens, skip_special_tokens=True
-                    )[0]
+# {src_lang: {tgt_lang: [prediction, ...]}}, in the order of test_data
+predictions = {src_lang: {} for src_lang in test_data}
+for src_lang, tgt_lang in tqdm(
+    [
+        (src_lang, tgt_lang)
+        for src_lang, values in test_data.items()
+        for tgt_lang in values
+    ]
+):
+    predictions[src_lang][tgt_lang] = translator.translate(
+        test_data[src_lang][tgt_lang].sources, src_lang, tgt_lang
+    )
 
 # Calculate metrics
+# {src_lang: {tgt_lang: {"sacrebleu": ..., "rougeL": ...}}}
 metrics = {
     src_lang: {
-        tgt_lang: {m: datasets.load_metric(m) for m in ("sacrebleu", "rouge")}
-        for tgt_lang, _ in values.items()
+        tgt_lang: pair_metrics(data, predictions[src_lang][tgt_lang])
+        for tgt_lang, data in values.items()
     }
     for src_lang, values in test_data.items()
 }
-for src_lang, values in test_data.items():
-    for tgt_lang, data in values.items():
-        for element in data:
-            for metric in metrics[src_lang][tgt_lang].values():
-                metric.add_batch(
-                    predictions=[
-                        element["prediction"].strip(string.punctuation).lower().split()
-                    ],
-                    references=[
-                        [element["target"].strip(string.punctuation).lower().split()]
-                    ],
-                )
-
-metrics = {
-    src_lang: {
-        tgt_lang: {name: metric.compute() for name, metric in metrics.items()}
-        for tgt_lang, metrics in values.items()
-    }
-    for src_lang, values in metrics.items()
-}
 
 # Compute tables
 tables = {
     "sacrebleu": {
-        src_lang: {
-            tgt_lang: metric["sacrebleu"]["score"]
-            for tgt_lang, metric in values.items()
-        }
+        src_lang: {tgt_lang: metric["sacrebleu"] for tgt_lang, metric in values.items()}
         for src_lang, values in metrics.items()
     },
     "rougeL": {
-        src_lang: {
-            tgt_lang: 100 * metric["rouge"]["rougeL"].mid.fmeasure
-            for tgt_lang, metric in values.items()
-        }
+        src_lang: {tgt_lang: metric["rougeL"] for tgt_lang, metric in values.items()}
         for src_lang, values in metrics.items()
     },
 }
@@ -0,0 +1,163 @@
+import itertools
+import re
+
+# Manuel de Codage to Unicode transliteration, as ordered replacements: every rule
+# applies to the output of the previous ones (e.g. the H of *X -> H̱ becomes ḥ), so
+# the order matters. If you desire to add capital letters (e.g. in proper names)
+# you need to add the asterisk * before the letter you want to capitalize
+MDC_RULES = [
+    # Capital letters with diacritics
+    ("*X", "H̱"),
+    ("*S", "Š"),
+    ("*T", "Ṯ"),
+    ("*D", "Ḏ"),
+    ("*A", "Ꜣ"),
+    ("*H", "Ḥ"),
+    # Letters with diacritics
+    ("X", "ẖ"),
+    ("S", "š"),
+    ("T", "ṯ"),
+    ("D", "ḏ"),
+    ("A", "ꜣ"),
+    ("H", "ḥ"),
+    # Other capital letters
+    ("*j", "J"),
+    ("*i", "I"),
+    ("*y", "Y"),
+    ("*a", "Ꜥ"),
+    ("*w", "W"),
+    ("*b", "B"),
+    ("*p", "P"),
+    ("*f", "F"),
+    ("*m", "M"),
+    ("*n", "N"),
+    ("*r", "R"),
+    ("*h", "H"),
+    ("*x", "Ḫ"),
+    ("*s", "S"),
+    ("*z", "Z"),
+    ("*q", "Q"),
+    ("*k", "K"),
+    ("*g", "G"),
+    ("*t", "T"),
+    ("*d", "D"),
+    # Ayin, kh and weak yod
+    ("a", "ꜥ"),
+    ("x", "ḫ"),
+    ("i", "i̯"),
+]
+
+
+# Apply the rules one after the other (reference version of MdcConverter)
+def mdc_to_unicode_chain(text, rules=MDC_RULES):
+    for pattern, replacement in rules:
+        text = text.replace(pattern, replacement)
+    return text
+
+
+# Patterns of the longest-match table of the rules: the patterns of the rules plus,
+# since a replacement can form a pattern of a later rule with the text around it
+# (e.g. **X -> *H̱ -> Ḥ̱), the patterns extended with that text
+def table_patterns(rules, max_length=8):
+    patterns = {pattern for pattern, _ in rules}
+    pending = list(patterns)
+    while pending:
+        pattern = pending.pop()
+        text = pattern
+        for i, (rule_pattern, replacement) in enumerate(rules):
+            for later_pattern, _ in rules[i:]:
+                for k in range(1, len(later_pattern)):
+                    before, after = later_pattern[:k], later_pattern[k:]
+                    extended = []
+                    if text.startswith(after):
+                        extended.append(before + pattern)
+                    if text.endswith(before):
+                        extended.append(pattern + after)
+                    for new_pattern in extended:
+                        if (
+                            new_pattern not in patterns
+                            and len(new_pattern) <= max_length
+                        ):
+                            patterns.add(new_pattern)
+                            pending.append(new_pattern)
+            text = text.replace(rule_pattern, replacement)
+
+    return patterns
+
+
+# The rules compiled into a longest-match table: each pattern of table_patterns is
+# mapped to the output of the whole chain on it, and a text is converted replacing
+# its longest matching patterns from left to right. A regex finds the patterns
+# longer than one character, the single characters of the text between them are
+# replaced with one pass each (they can be replaced in any order, as no replacement
+# of a character contains another replaced character).
+# This is not a single scan: a short text is converted about as fast as by the
+# chain (so Run.py gains nothing from it), the speedup comes from converting many
+# texts at once with convert_many or convert_file
+class MdcConverter:
+    def __init__(self, rules=MDC_RULES):
+        table = {
+            pattern: mdc_to_unicode_chain(pattern, rules)
+            for pattern in table_patterns(rules)
+        }
+        self.characters = [
+            (pattern, value) for pattern, value in table.items() if len(pattern) == 1
+        ]
+        for pattern, value in self.characters:
+            if any(other in value for other, _ in self.characters if other != pattern):
+                raise ValueError(f"The replacement of `{pattern}` is not final")
+        self.longer = {
+            pattern: value for pattern, value in table.items() if len(pattern) > 1
+        }
+        # Texts without the first character of any longer pattern skip the regex
+        self.leads = {pattern[0] for pattern in self.longer}
+        self.pattern = re.compile(
+            "("
+            + "|".join(
+                re.escape(pattern)
+                for pattern in sorted(self.longer, key=len, reverse=True)
+            )
+            + ")"
+        )
+
+    def _replace_characters(self, text):
+        for pattern, value in self.characters:
+            text = text.replace(pattern, value)
+        return text
+
+    def __call__(self, text):
+        if not any(lead in text for lead in self.leads):
+            return self._replace_characters(text)
+
+        # Texts alternated with the longer patterns found in them; the texts are
+        # converted together, joined by a character none of them contains
+        pieces = self.pattern.split(text)
+        if "\0" in text:
+            pieces[::2] = [self._replace_characters(piece) for piece in pieces[::2]]
+        else:
+            pieces[::2] = self._replace_characters("\0".join(pieces[::2])).split("\0")
+        pieces[1::2] = [self.longer[piece] for piece in pieces[1::2]]
+        return "".join(pieces)
+
+    # Convert many texts at once: texts without line breaks (no rule involves them)
+    # are joined and converted as one text
+    def convert_many(self, texts):
+        texts = list(texts)
+        if any("\n" in text for text in texts):
+            return [self(text) for text in texts]
+        return self("\n".join(texts)).split("\n") if texts else []
+
+    # Convert a file of transliterations, chunk_lines lines at a time
+    def convert_file(self, input_path, output_path, chunk_lines=100_000):
+        with open(input_path, encoding="utf-8") as input_file, open(
+            output_path, "w", encoding="utf-8"
+        ) as output_file:
+            while True:
+                lines = list(itertools.islice(input_file, chunk_lines))
+                if not lines:
+                    break
+                # Chunks end at line breaks, which no pattern spans
+                output_file.write(self("".join(lines)))
+
+
+mdc_to_unicode = MdcConverter()
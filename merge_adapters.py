@@ -0,0 +1,18 @@
+from transformers import M2M100ForConditionalGeneration, M2M100Tokenizer
+
+from utils import load_lora_adapters, merge_lora_adapter
+
+# Checkpoint with the LoRA adapters saved by train.py, adapter to merge and folder
+# of the standalone model
+adapters_checkpoint = "checkpoint_total_steps=1000_loss=1.00"
+adapter = "ea-en"
+output_folder = "merged_model"
+
+# Load the base model with the adapters and fold the adapter into its weights
+model = load_lora_adapters(adapters_checkpoint, M2M100ForConditionalGeneration)
+merge_lora_adapter(model, adapter)
+
+# Save model and tokenizer, ready for inference.py and Run.py
+model.save_pretrained(output_folder)
+M2M100Tokenizer.from_pretrained(model.name_or_path).save_pretrained(output_folder)
+print(f"Adapter {adapter} merged in {output_folder}")
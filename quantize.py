@@ -0,0 +1,121 @@
+import glob
+import json
+import os
+
+import pandas as pd
+from tqdm.auto import tqdm
+
+from evaluation import latency_percentiles, pair_metrics, timed_translate
+from translator import Translator
+from utils import load_data_from_folder, processed_data
+
+# Model to compare (fp32 against dynamic int8, both on the cpu) and decoding
+# settings, as in inference.py
+model_path = "ea9all"
+tokenizer_path = "facebook/m2m100_418M"
+generate_kwargs = {"preset": "full_beam"}
+# Sentences translated together when measuring the latency (1 as in serving) and
+# sentences of each pair used (None for all of them)
+latency_batch_size = 1
+max_sentences = None
+# Largest drop of sacreBLEU/rougeL (in points) accepted for a pair
+max_metric_drop = 1.0
+report_path = "quantization_report.json"
+
+# Optionally export the model to ONNX (encoder and decoders) with int8 weights for
+# onnxruntime, which needs the optimum package
+export_onnx = False
+onnx_folder = "onnx_model"
+
+# Load and process data
+test_data = processed_data(load_data_from_folder("test_data"))
+pairs = [
+    (src_lang, tgt_lang)
+    for src_lang, values in test_data.items()
+    for tgt_lang in values
+]
+
+translators = {
+    "fp32": Translator(model_path, tokenizer_path, device="cpu", **generate_kwargs),
+    "int8": Translator(model_path, tokenizer_path, quantize=True, **generate_kwargs),
+}
+
+# Translate every pair with both models, measuring the latency of each batch
+report = []
+for src_lang, tgt_lang in tqdm(pairs):
+    data = test_data[src_lang][tgt_lang]
+    sentences = data.sources[:max_sentences]
+    row = {"pair": f"{src_lang}-{tgt_lang}", "sentences": len(sentences)}
+    predictions = {}
+    for name, translator in translators.items():
+        predictions[name], latencies = timed_translate(
+            translator, sentences, src_lang, tgt_lang, latency_batch_size
+        )
+        metrics = pair_metrics(data, predictions[name])
+        row.update({f"{metric}_{name}": value for metric, value in metrics.items()})
+        row.update(
+            {
+                f"{percentile}_ms_{name}": value
+                for percentile, value in latency_percentiles(latencies).items()
+            }
+        )
+        row[f"seconds_{name}"] = sum(latencies)
+
+    row["speedup"] = row["seconds_fp32"] / row["seconds_int8"]
+    row["identical"] = sum(
+        fp32 == int8 for fp32, int8 in zip(predictions["fp32"], predictions["int8"])
+    ) / max(len(sentences), 1)
+    row["metric_drop"] = max(
+        row[f"{metric}_fp32"] - row[f"{metric}_int8"]
+        for metric in ("sacrebleu", "rougeL")
+    )
+    report.append(row)
+
+with open(report_path, "w") as f:
+    json.dump(report, f, indent=2)
+
+table = pd.DataFrame(report).set_index("pair")
+print(
+    table[
+        [
+            "sacrebleu_fp32",
+            "sacrebleu_int8",
+            "rougeL_fp32",
+            "rougeL_int8",
+            "p50_ms_fp32",
+            "p50_ms_int8",
+            "p90_ms_fp32",
+            "p90_ms_int8",
+            "speedup",
+            "identical",
+        ]
+    ].round(2)
+)
+print(
+    f"Speedup: {table['seconds_fp32'].sum() / table['seconds_int8'].sum():.2f}x "
+    f"over all pairs"
+)
+
+# Quality losses are reported, never hidden
+losing_pairs = table.index[table["metric_drop"] > max_metric_drop].tolist()
+if losing_pairs:
+    print(
+        f"WARNING: int8 loses more than {max_metric_drop} points of sacreBLEU or "
+        f"rougeL on {', '.join(losing_pairs)}"
+    )
+
+if export_onnx:
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    ORTModelForSeq2SeqLM.from_pretrained(model_path, export=True).save_pretrained(
+        onnx_folder
+    )
+    translators["fp32"].tokenizer.save_pretrained(onnx_folder)
+    quantization_config = AutoQuantizationConfig.avx2(is_static=False)
+    for path in glob.glob(os.path.join(onnx_folder, "*.onnx")):
+        file_name = os.path.basename(path)
+        ORTQuantizer.from_pretrained(onnx_folder, file_name=file_name).quantize(
+            save_dir=onnx_folder, quantization_config=quantization_config
+        )
+    print(f"Model exported to {onnx_folder}")
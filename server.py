@@ -0,0 +1,257 @@
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from translator import TranslationCache, Translator
+from utils import lang_to_m2m_lang_id
+
+# Model served, address of the server and decoding settings (as in Run.py, see
+# translator.DECODING_PRESETS)
+model_path = "mattiadc/hiero-transformer"
+host = "127.0.0.1"
+port = 8000
+generate_kwargs = {"preset": "full_beam"}
+
+# The requests of the same language pair arriving within batch_window seconds of
+# the first one are translated together, up to max_batch_size sentences (a larger
+# request is translated alone, max_batch_size sentences per generate call)
+batch_window = 0.01
+max_batch_size = 32
+# Latencies kept for the percentiles of /metrics
+metrics_window = 10_000
+
+
+# Queue of the requests of one language pair, with the task translating them in
+# batches. A request that would take a batch over max_batch_size sentences is held
+# back as the first one of the next batch
+class PairQueue:
+    def __init__(self, batcher, src_lang, tgt_lang):
+        self.batcher = batcher
+        self.src_lang = src_lang
+        self.tgt_lang = tgt_lang
+        self.queue = asyncio.Queue()
+        self.sentences = 0
+        self.held = None
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.held is None:
+                batch = [await self.queue.get()]
+            else:
+                batch, self.held = [self.held], None
+            size = len(batch[0][0])
+            deadline = loop.time() + self.batcher.batch_window
+            while size < self.batcher.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if size + len(request[0]) > self.batcher.max_batch_size:
+                    self.held = request
+                    break
+                batch.append(request)
+                size += len(request[0])
+            self.sentences -= size
+            await self.batcher.translate_batch(self.src_lang, self.tgt_lang, batch)
+
+
+# Micro-batching of the translation requests: every request waits in the queue of
+# its language pair and the requests collected from a queue are translated by one
+# generate call (one at a time, on the thread of the executor), then every caller
+# gets its own translations
+class MicroBatcher:
+    def __init__(
+        self, translator, batch_window=0.01, max_batch_size=32, metrics_window=10_000
+    ):
+        self.translator = translator
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queues = {}
+
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_sentences = 0
+        self.latencies = deque(maxlen=metrics_window)
+        self.queue_times = deque(maxlen=metrics_window)
+        self.generate_times = deque(maxlen=metrics_window)
+        self.batch_sizes = deque(maxlen=metrics_window)
+
+    # Translations of the sentences, as translator.translate
+    async def translate(self, sentences, src_lang, tgt_lang):
+        if not sentences:
+            return []
+        if (src_lang, tgt_lang) not in self.queues:
+            self.queues[(src_lang, tgt_lang)] = PairQueue(self, src_lang, tgt_lang)
+        pair_queue = self.queues[(src_lang, tgt_lang)]
+
+        future = asyncio.get_running_loop().create_future()
+        start = time.perf_counter()
+        pair_queue.sentences += len(sentences)
+        pair_queue.queue.put_nowait((sentences, future, start))
+        self.requests += 1
+        try:
+            return await future
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    async def translate_batch(self, src_lang, tgt_lang, batch):
+        start = time.perf_counter()
+        for _, _, arrival in batch:
+            self.queue_times.append(start - arrival)
+        sentences = [sentence for request in batch for sentence in request[0]]
+
+        try:
+            translations = await asyncio.get_running_loop().run_in_executor(
+                self.executor,
+                lambda: self.translator.translate(
+                    sentences, src_lang, tgt_lang, batch_size=self.max_batch_size
+                ),
+            )
+        except Exception as error:
+            self.errors += len(batch)
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        self.generate_times.append(time.perf_counter() - start)
+        self.batches += 1
+        self.batched_sentences += len(sentences)
+        self.batch_sizes.append(len(sentences))
+
+        offset = 0
+        for request_sentences, future, _ in batch:
+            # The caller may be gone (e.g. disconnected)
+            if not future.done():
+                future.set_result(
+                    translations[offset : offset + len(request_sentences)]
+                )
+            offset += len(request_sentences)
+
+    def metrics(self):
+        def percentiles(values):
+            if not values:
+                return None
+            return dict(
+                zip(
+                    ("p50", "p90", "p99", "max"),
+                    np.percentile(values, [50, 90, 99, 100]).round(4).tolist(),
+                )
+            )
+
+        return {
+            "uptime": round(time.perf_counter() - self.started, 1),
+            "requests": self.requests,
+            "errors": self.errors,
+            "batches": self.batches,
+            "mean_batch_size": (
+                self.batched_sentences / self.batches if self.batches else None
+            ),
+            "queue_depth": {
+                f"{src_lang}-{tgt_lang}": pair_queue.sentences
+                for (src_lang, tgt_lang), pair_queue in self.queues.items()
+            },
+            "latency": percentiles(self.latencies),
+            "queue_time": percentiles(self.queue_times),
+            "generate_time": percentiles(self.generate_times),
+            "batch_size": percentiles(self.batch_sizes),
+        }
+
+
+# Minimal HTTP/1.1 server (keep-alive, JSON bodies) on top of the batcher:
+#   POST /translate {"src": "tnt", "tgt": "de", "text": "..."} -> {"translation": ...}
+#   POST /translate {"src": ..., "tgt": ..., "texts": [...]} -> {"translations": [...]}
+#   GET /metrics -> MicroBatcher.metrics()
+class TranslationServer:
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    async def handle(self, request_method, path, body):
+        if request_method == "GET" and path == "/metrics":
+            return 200, self.batcher.metrics()
+        if path != "/translate":
+            return 404, {"error": f"Unknown path `{path}`"}
+        if request_method != "POST":
+            return 405, {"error": "Use POST"}
+
+        try:
+            request = json.loads(body)
+            src_lang, tgt_lang = request["src"], request["tgt"]
+            texts = request["texts"] if "texts" in request else [request["text"]]
+        except (ValueError, KeyError, TypeError) as error:
+            return 400, {"error": f"Invalid request: {error!r}"}
+        for lang in (src_lang, tgt_lang):
+            if lang not in lang_to_m2m_lang_id:
+                return 400, {"error": f"Unknown language `{lang}`"}
+        if not isinstance(texts, list) or not all(
+            isinstance(text, str) for text in texts
+        ):
+            return 400, {"error": "The texts must be a list of strings"}
+
+        translations = await self.batcher.translate(texts, src_lang, tgt_lang)
+        if "texts" in request:
+            return 200, {"translations": translations}
+        return 200, {"translation": translations[0]}
+
+    async def connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                request_method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                try:
+                    status, response = await self.handle(request_method, path, body)
+                except Exception as error:
+                    status, response = 500, {"error": repr(error)}
+
+                data = json.dumps(response, ensure_ascii=False).encode()
+                close = headers.get("connection", "").lower() == "close"
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    "Content-Type: application/json; charset=utf-8\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode()
+                    + data
+                )
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.connection, host, port)
+        print(f"Serving on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+async def main():
+    translator = Translator(model_path, cache=TranslationCache(), **generate_kwargs)
+    batcher = MicroBatcher(translator, batch_window, max_batch_size, metrics_window)
+    await TranslationServer(batcher).serve(host, port)
+
+
+asyncio.run(main())
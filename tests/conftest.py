@@ -0,0 +1,21 @@
+import json
+import os
+import sys
+import zipfile
+
+import pytest
+
+# The modules of the repository are top-level scripts
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+# Datapoints of the bundled test_and_validation_data.zip (test and validation data)
+@pytest.fixture(scope="session")
+def bundled_data():
+    with zipfile.ZipFile(os.path.join(ROOT, "test_and_validation_data.zip")) as archive:
+        return [
+            datapoint
+            for name in ("test_data.json", "validation_data.json")
+            for datapoint in json.loads(archive.read(name))
+        ]
@@ -0,0 +1,27 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from utils import cut_batches
+
+
+def lengths_data(source_lengths, target_lengths):
+    return SimpleNamespace(
+        source_lengths=np.array(source_lengths), target_lengths=np.array(target_lengths)
+    )
+
+
+def test_cut_batches_by_sentences():
+    data = lengths_data([5] * 10, [5] * 10)
+    batches = cut_batches(data, np.arange(10), 4)
+    assert batches == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+
+# With a token budget the batches are capped by both sentences and tokens
+def test_cut_batches_by_sentences_and_tokens():
+    data = lengths_data([2] * 6 + [20] * 4 + [100], [2] * 6 + [20] * 4 + [100])
+    batches = cut_batches(data, np.arange(11), 4, max_tokens=100)
+    # Short examples: 4 sentences; long: 2 (2 * 40 tokens); longer than the budget: 1
+    assert batches == [[0, 1, 2, 3], [4, 5], [6, 7], [8, 9], [10]]
+    for batch in batches:
+        assert len(batch) <= 4
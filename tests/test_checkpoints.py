@@ -0,0 +1,78 @@
+import time
+
+import pytest
+import torch
+
+from utils import CheckpointManager
+
+
+def saved_state(path, config, **state):
+    model = torch.nn.Linear(2, 2)
+    optimizer = torch.optim.AdamW(model.parameters())
+    checkpoints = CheckpointManager(state_path=str(path), config=config)
+    checkpoints.save_state(model, optimizer, total_steps=10, **state)
+    checkpoints.close()
+    return model, optimizer
+
+
+def test_state_resumed_by_same_config(tmp_path):
+    config = {"langs": [("ea", "de")], "lora_adapters": None, "model": "m2m100"}
+    model, optimizer = saved_state(tmp_path / "state.pt", config)
+
+    checkpoints = CheckpointManager(
+        state_path=str(tmp_path / "state.pt"), config=config
+    )
+    assert checkpoints.load_state(model, optimizer) == {
+        "total_steps": 10,
+        "config": config,
+    }
+
+
+def test_state_of_other_config_refused(tmp_path):
+    config = {"langs": [("ea", "de")], "lora_adapters": None, "model": "m2m100"}
+    model, optimizer = saved_state(tmp_path / "state.pt", config)
+
+    checkpoints = CheckpointManager(
+        state_path=str(tmp_path / "state.pt"), config={**config, "langs": []}
+    )
+    with pytest.raises(ValueError, match="config"):
+        checkpoints.load_state(model, optimizer)
+
+
+def test_finished_state_refused(tmp_path):
+    model, optimizer = saved_state(tmp_path / "state.pt", None, finished=True)
+
+    checkpoints = CheckpointManager(state_path=str(tmp_path / "state.pt"))
+    with pytest.raises(ValueError, match="finished"):
+        checkpoints.load_state(model, optimizer)
+
+
+class SlowCheckpointManager(CheckpointManager):
+    def _write_best(self, model, state_dict, fname, removed):
+        time.sleep(0.5)
+
+
+# Saving the state right after a best model does not wait for its write
+def test_checkpoints_queued_without_waiting(tmp_path):
+    model = torch.nn.Linear(2, 2)
+    optimizer = torch.optim.AdamW(model.parameters())
+    checkpoints = SlowCheckpointManager(state_path=str(tmp_path / "state.pt"))
+
+    start = time.perf_counter()
+    checkpoints.save_best(model, str(tmp_path / "best"))
+    checkpoints.save_state(model, optimizer, total_steps=10)
+    assert time.perf_counter() - start < 0.25
+
+    checkpoints.close()
+    assert (tmp_path / "state.pt").exists()
+
+
+# Errors of the background writes are raised by the following calls
+def test_checkpoint_errors_raised(tmp_path):
+    model = torch.nn.Linear(2, 2)
+    optimizer = torch.optim.AdamW(model.parameters())
+    checkpoints = CheckpointManager(state_path=str(tmp_path / "missing" / "state.pt"))
+
+    checkpoints.save_state(model, optimizer, total_steps=10)
+    with pytest.raises(RuntimeError):
+        checkpoints.close()
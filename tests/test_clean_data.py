@@ -0,0 +1,39 @@
+import copy
+
+import pytest
+
+from utils import clean_data
+
+
+# Cleaning with a pool of workers gives the same datapoints, in the same order, as
+# the serial path
+@pytest.mark.parametrize("chunk_size", [1, 7, 100, 10_000])
+@pytest.mark.parametrize("block_size", [50, 100_000])
+def test_parallel_cleaning_matches_serial(bundled_data, chunk_size, block_size):
+    serial = list(clean_data(copy.deepcopy(bundled_data), num_workers=1))
+    parallel = list(
+        clean_data(
+            copy.deepcopy(bundled_data),
+            num_workers=3,
+            chunk_size=chunk_size,
+            block_size=block_size,
+        )
+    )
+    assert parallel == serial
+    assert serial != bundled_data
+
+
+# The datapoints are cleaned and yielded one block at a time
+def test_clean_data_streams_blocks(bundled_data):
+    consumed = []
+
+    def datapoints():
+        for datapoint in copy.deepcopy(bundled_data):
+            consumed.append(datapoint)
+            yield datapoint
+
+    cleaned = clean_data(datapoints(), block_size=10)
+    next(cleaned)
+    # batch_it reads one datapoint past the block
+    assert len(consumed) <= 11
+    assert len(list(cleaned)) == len(bundled_data) - 1
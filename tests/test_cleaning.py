@@ -0,0 +1,24 @@
+import pytest
+
+import cleaning
+import utils
+
+
+# The compiled cleaning functions give the same output as the reference ones of
+# utils.py on every text of the bundled data
+@pytest.mark.parametrize(
+    "field, function_name",
+    [
+        ("source", "clean_graphics"),
+        ("transliteration", "clean_wChar"),
+        ("target", "clean_traduction"),
+    ],
+)
+def test_compiled_cleaning_matches_reference(bundled_data, field, function_name):
+    texts = [datapoint[field] for datapoint in bundled_data if field in datapoint]
+    assert texts
+
+    compiled = getattr(cleaning, function_name)
+    reference = getattr(utils, function_name)
+    for text in texts:
+        assert compiled(text) == reference(text), text
@@ -0,0 +1,34 @@
+import io
+import json
+
+import pytest
+
+from utils import iter_json_array
+
+ARRAYS = [
+    "[]",
+    " [ ] ",
+    "[12.5, 3]",
+    "[1e10, -0.25E-3 ,7]",
+    '[true, false, null, "a,]b", 1.0]',
+    '[{"a": [1, 2.5]}, {"b": "]"}, [3e2]]',
+]
+
+
+# Every element is decoded whatever the chunks the file is read in
+@pytest.mark.parametrize("text", ARRAYS)
+@pytest.mark.parametrize("read_size", [1, 2, 3, 4, 7, 1 << 20])
+def test_iter_json_array(text, read_size):
+    assert list(iter_json_array(io.StringIO(text), read_size)) == json.loads(text)
+
+
+def test_iter_json_array_on_bundled_data(bundled_data):
+    text = json.dumps(bundled_data)
+    assert list(iter_json_array(io.StringIO(text), 1000)) == bundled_data
+
+
+@pytest.mark.parametrize("text", ["[1 2]", "[12.]", "[1,", "{}"])
+@pytest.mark.parametrize("read_size", [1, 4, 1 << 20])
+def test_iter_json_array_invalid(text, read_size):
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO(text), read_size))
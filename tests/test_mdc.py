@@ -0,0 +1,76 @@
+import itertools
+
+import pytest
+
+from mdc import MDC_RULES, MdcConverter, mdc_to_unicode, mdc_to_unicode_chain
+
+# Characters of the rules, plus separators, a character no rule involves and the
+# line break and NUL handled apart by the converter
+CHARACTERS = sorted(
+    {character for rule in MDC_RULES for text in rule for character in text}
+    | set(" .,=-e\n\0")
+)
+
+
+# Every text up to 3 characters long is converted as by the chain of replacements
+def test_matches_chain_on_all_short_texts():
+    for length in range(4):
+        for characters in itertools.product(CHARACTERS, repeat=length):
+            text = "".join(characters)
+            assert mdc_to_unicode(text) == mdc_to_unicode_chain(text), repr(text)
+
+
+# Replacements forming patterns of later rules with the text around them
+@pytest.mark.parametrize(
+    "text",
+    [
+        "**X",
+        "***X",
+        "**H",
+        "**h",
+        "*X*H",
+        "**X**X",
+        "X*X",
+        "*i",
+        "i*i",
+        "**a",
+        "*ra m p,t",
+        "Htp di nsw wsir nb DDw",
+        "*imn-ra Hr **Xnsw",
+        "a\0*X\0**X",
+        "\0",
+        "*\0X",
+        "*X\n**X\n*",
+        "*\nX",
+    ],
+)
+def test_matches_chain_on_chained_cases(text):
+    assert mdc_to_unicode(text) == mdc_to_unicode_chain(text)
+
+
+def test_matches_chain_on_long_text():
+    text = "".join(itertools.islice(itertools.cycle(CHARACTERS), 10_000)) * 3
+    assert mdc_to_unicode(text) == mdc_to_unicode_chain(text)
+
+
+def test_convert_many():
+    texts = ["**X", "", "*ra m p,t", "a\0*H", "Htp di nsw"]
+    expected = [mdc_to_unicode_chain(text) for text in texts]
+    assert mdc_to_unicode.convert_many(texts) == expected
+    # Texts with line breaks are converted one by one
+    assert mdc_to_unicode.convert_many(texts + ["*X\n**X"]) == expected + [
+        mdc_to_unicode_chain("*X\n**X")
+    ]
+    assert mdc_to_unicode.convert_many([]) == []
+
+
+@pytest.mark.parametrize("chunk_lines", [1, 3, 100_000])
+def test_convert_file(tmp_path, chunk_lines):
+    lines = ["**X*H", "", "*ra m p,t", "a\0*x", "Htp di nsw wsir", "*"] * 5
+    text = "\n".join(lines) + "\n"
+    input_path = tmp_path / "input.txt"
+    output_path = tmp_path / "output.txt"
+    input_path.write_text(text, encoding="utf-8")
+
+    MdcConverter().convert_file(input_path, output_path, chunk_lines)
+    assert output_path.read_text(encoding="utf-8") == mdc_to_unicode_chain(text)
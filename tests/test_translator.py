@@ -0,0 +1,53 @@
+import pytest
+import torch
+
+from translator import (
+    DECODING_PRESETS,
+    MaxLengthPerSentenceLogitsProcessor,
+    Translator,
+    decoding_settings,
+)
+
+
+def test_decoding_settings():
+    assert decoding_settings({"num_beams": 3}) == {"num_beams": 3}
+    assert decoding_settings({"preset": "small_beam", "num_beams": 3}) == {
+        **DECODING_PRESETS["small_beam"],
+        "num_beams": 3,
+    }
+    with pytest.raises(ValueError):
+        decoding_settings({"preset": "unknown"})
+
+
+# The preset of a call replaces the one of the Translator, the arguments given to
+# the Translator still apply
+def test_call_preset_replaces_translator_preset():
+    translator = Translator.__new__(Translator)
+    translator.cache = None
+    translator.generate_kwargs = {"preset": "full_beam", "max_length_offset": 5}
+    calls = []
+    translator._generate_many = lambda *args, **generate_kwargs: calls.append(
+        generate_kwargs
+    )
+
+    translator.translate_many(["a"], "tnt", ["de"], preset="greedy")
+    translator.translate_many(["a"], "tnt", ["de"])
+    assert calls == [
+        {**DECODING_PRESETS["greedy"], "max_length_offset": 5},
+        {**DECODING_PRESETS["full_beam"], "max_length_offset": 5},
+    ]
+
+
+# Every sentence (with its beams) ends at its own maximum length
+def test_max_length_per_sentence():
+    processor = MaxLengthPerSentenceLogitsProcessor([2, 4], eos_token_id=1)
+    scores = torch.zeros(4, 5)  # 2 sentences x 2 beams
+    input_ids = torch.zeros(4, 2, dtype=torch.long)
+
+    scores = processor(input_ids, scores)
+    assert (scores[:2].argmax(-1) == 1).all()
+    assert torch.isinf(scores[:2, [0, 2, 3, 4]]).all()
+    assert (scores[2:] == 0).all()
+
+    # The forced language token is left alone
+    assert (processor(input_ids[:, :1], torch.zeros(4, 5)) == 0).all()
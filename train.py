@@ -1,20 +1,35 @@
-import copy
 import json
-import shutil
+import os
 
 import numpy as np
 import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from tqdm.auto import tqdm
 from transformers import M2M100ForConditionalGeneration, M2M100Tokenizer
 
+from cleaning import CleaningCache
 from utils import (
-    batch_it,
+    CheckpointManager,
+    Evaluator,
+    LossMeter,
+    Prefetcher,
+    TrainingProfiler,
+    add_lora_adapters,
+    broadcast_object,
     clean_data,
+    init_distributed,
+    iter_data_from_folder,
     lang_to_m2m_lang_id,
+    length_bucketed_batches,
     load_data_from_folder,
+    padding_fraction,
     processed_data,
+    rank_path,
+    set_lora_adapter,
+    shard_batches,
+    tokenize_pair_data,
     training_step,
-    validation_step,
 )
 
 # Epochs, batch, periods variables
@@ -24,7 +39,52 @@ eval_period = 1000
 total_steps = 0
 best_eval_loss = float("inf")
 max_models = 1
-topk_models = []
+
+# Training losses read back from the device (and logged) every loss_flush_steps steps
+loss_flush_steps = 50
+loss_log_path = "training_losses.jsonl"
+
+# Time per stage and throughput per pair, logged at the end of every epoch.
+# profile_synchronize waits for the gpu after every stage: exact times, slower steps
+profile_log_path = "training_profile.jsonl"
+profile_synchronize = False
+
+# Resume from the training state saved every eval_period steps (by a run with the
+# same langs, lora_adapters and base model that did not finish)
+resume = False
+training_state_path = "training_state.pt"
+
+# Cleaning workers, texts per chunk sent to each worker and cache of cleaned texts
+clean_workers = os.cpu_count()
+clean_chunk_size = 1000
+clean_cache_path = "cleaning_cache.sqlite"
+
+# Tokens per sentence and folder of the pre-tokenized training and validation data
+max_length = 64
+tokenized_cache_dir = "tokenized_cache"
+
+# Batches per pool of examples sorted by length before batching
+bucket_pool_batches = 50
+
+# Optional cap of padded source+target tokens per batch, on top of batch_size
+# sentences (None for no cap). Batches of long sentences then hold fewer sentences,
+# so the learning rate may need tuning; 2048 is the size of a full batch of 16
+# sentences of 64 tokens each
+max_batch_tokens = None
+
+# Training batches prepared ahead of the step and threads preparing them
+prefetch_batches = 4
+prefetch_workers = 2
+
+# Validation batch size and token budget, and validation examples per pair used
+# by the quick evaluations every eval_period steps (None to always validate on all)
+eval_batch_size = 64
+eval_max_batch_tokens = 4 * max_batch_tokens if max_batch_tokens else None
+quick_eval_size = None
+
+# Data-parallel training with torchrun --nproc_per_node=N train.py: every process
+# trains on its shard of the batches, rank 0 validates and saves the checkpoints
+distributed_backend = "gloo"
 
 # Choose the pairs of languages to train and validate
 langs = [
@@ -39,19 +99,50 @@ langs = [
     #  ('tnt', 'wordClass'),
 ]
 
-
-# Load data
-training_data = load_data_from_folder("training_data")
+# LoRA mode: {(src_lang, tgt_lang): adapter} for every pair of langs, e.g.
+# {pair: "-".join(pair) for pair in langs} for one adapter per pair. Only the
+# adapters are trained and saved in the checkpoints (merge_adapters.py folds them
+# into a standalone model), None to fine-tune the whole model
+lora_adapters = None
+lora_rank = 8
+lora_alpha = 16
+lora_learning_rate = 1e-4
+
+
+rank, local_rank, world_size = init_distributed(distributed_backend)
+device = f"cuda:{local_rank}" if torch.cuda.is_available() else "cpu"
+if device == "cpu":
+    # The processes share the cores of the machine
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+    clean_workers = max(1, clean_workers // world_size)
+
+# Rank 0 cleans and tokenizes the data first, the other processes then find them
+# in the caches
+if rank != 0:
+    dist.barrier()
+
+# Load data, training data are streamed through the cleaning into processed_data
 validation_data = load_data_from_folder("validation_data")
 
 # Clean data
-training_data = clean_data(training_data)
+cleaning_cache = CleaningCache(clean_cache_path)
+training_data = clean_data(
+    iter_data_from_folder("training_data"),
+    clean_workers,
+    clean_chunk_size,
+    cleaning_cache,
+)
 
 # Filter and extract data
-# Dict[str, Dict[str, List[Dict[str, str]]]]
-# {src_lang: {tgt_lang: [{'source': ..., 'target': ...}]}}
-training_data = processed_data(training_data)
-validation_data = processed_data(validation_data)
+# Dict[str, Dict[str, PairData]]
+# {src_lang: {tgt_lang: [{'source': ..., 'target': ..., 'metadata': ...}]}}
+# ea/tnt -> de data are also needed to augment ea/tnt -> en
+training_pairs = set(langs) | {
+    (src_lang, "de") for src_lang, tgt_lang in langs if tgt_lang == "en"
+}
+training_data = processed_data(training_data, training_pairs)
+cleaning_cache.close()
+validation_data = processed_data(validation_data, langs)
 
 
 # Adding traduction of corpus and vocabulary
@@ -60,21 +151,27 @@ with open("translations_de2en.json", encoding="utf-8") as f:
     translations = json.load(f)
 
 for lang in ("ea", "tnt"):
+    if (lang, "en") not in langs:
+        continue
+
     ids_sentence = {
         element["metadata"]["id_sentence"]
         for element in training_data[lang]["en"]
         if "id_sentence" in element["metadata"]
     }
 
+    # The new examples share source and metadata with the de ones
+    metadata_table = training_data[lang]["en"].metadata_table
     for element in training_data[lang]["de"]:
         if (
             "id_sentence" in element["metadata"]
             and element["metadata"]["id_sentence"] not in ids_sentence
         ):
-            new_element = copy.deepcopy(element)
-            new_element["target"] = translations[element["target"]]
-            new_element["metadata"]["target_lang"] = "en"
-            training_data[lang]["en"].append(new_element)
+            training_data[lang]["en"].add(
+                element["source"],
+                translations[element["target"]],
+                metadata_table.derive(element["metadata"], target_lang="en"),
+            )
 
     print(
         f'{lang} -> en: Dopo la traduzione abbiamo {len(training_data[lang]["en"])} datapoints.'
@@ -82,116 +179,224 @@ for lang in ("ea", "tnt"):
 
 # loading model
 model = M2M100ForConditionalGeneration.from_pretrained("facebook/m2m100_418M").to(
-    "cuda:0"
+    device
 )
 tokenizer = M2M100Tokenizer.from_pretrained("facebook/m2m100_418M")
-optimizer = torch.optim.Adam(model.parameters(), lr=3e-5)
+if lora_adapters is None:
+    optimizer = torch.optim.Adam(model.parameters(), lr=3e-5)
+else:
+    add_lora_adapters(model, sorted(set(lora_adapters.values())), lora_rank, lora_alpha)
+    optimizer = torch.optim.Adam(
+        [parameter for parameter in model.parameters() if parameter.requires_grad],
+        lr=lora_learning_rate,
+    )
 
 
-# Training
-validation_losses = {}
-validation_data_batched = [
-    (src_lang, trg_lang, batch)
-    for src_lang, values in validation_data.items()
-    for trg_lang, data in values.items()
-    for batch in batch_it(data, batch_size)
-    if (src_lang, trg_lang) in langs
-]
+# Time of the stages of the training, from the tokenization of the data on
+profiler = TrainingProfiler(
+    rank_path(profile_log_path, rank), profile_synchronize, verbose=rank == 0
+)
 
-for epoch in range(epochs):
-    print(f"Starting epoch {epoch + 1}")
+# Tokenize once the pairs to train and validate
+# {(src_lang, tgt_lang): TokenizedPairData}
+with profiler.stage("tokenization", "all"):
+    tokenized_training_data, tokenized_validation_data = (
+        {
+            (src_lang, tgt_lang): tokenize_pair_data(
+                data[src_lang][tgt_lang],
+                tokenizer,
+                lang_to_m2m_lang_id[src_lang],
+                lang_to_m2m_lang_id[tgt_lang],
+                max_length,
+                tokenized_cache_dir,
+            )
+            for src_lang, tgt_lang in langs
+        }
+        for data in (training_data, validation_data)
+    )
 
-    for src_lang, values in training_data.items():
-        for data in values.values():
-            np.random.shuffle(data)
+if rank == 0 and world_size > 1:
+    dist.barrier()
 
-    training_data_batched = [
-        (src_lang, trg_lang, batch)
-        for src_lang, values in training_data.items()
-        for trg_lang, data in values.items()
-        for batch in batch_it(data, batch_size)
-        if (src_lang, trg_lang) in langs
-    ]
 
-    np.random.shuffle(training_data_batched)
+# Collate the batch, pinned in memory to overlap the copy to the GPU with the step
+def prepare_training_batch(item):
+    src_lang, tgt_lang, batch = item
+    return (
+        src_lang,
+        tgt_lang,
+        tokenized_training_data[(src_lang, tgt_lang)].collate(
+            batch, pin_memory=model.device.type == "cuda"
+        ),
+    )
+
+
+# Training
+validation_losses = {}
+checkpoints = CheckpointManager(
+    max_models,
+    training_state_path,
+    adapters_only=lora_adapters is not None,
+    config={
+        "langs": langs,
+        "lora_adapters": lora_adapters,
+        "model": model.name_or_path,
+    },
+)
+loss_meter = LossMeter(rank_path(loss_log_path, rank), loss_flush_steps)
+state = checkpoints.load_state(model, optimizer) if resume else None
+
+# The gradients are averaged between the processes at every backward. The adapters
+# of the pairs not in a batch get no gradients
+training_model = (
+    DistributedDataParallel(model, find_unused_parameters=lora_adapters is not None)
+    if world_size > 1
+    else model
+)
+start_epoch = 0
+if state is not None:
+    total_steps = state["total_steps"]
+    best_eval_loss = state["best_eval_loss"]
+    validation_losses = state["validation_losses"]
+    start_epoch = state["epoch"]
+    print(f"Resuming from epoch {start_epoch + 1}, step {total_steps}")
+
+evaluator = Evaluator(
+    tokenized_validation_data,
+    model,
+    tokenizer,
+    eval_batch_size,
+    eval_max_batch_tokens,
+    quick_eval_size,
+    adapters=lora_adapters,
+)
+
+for epoch in range(start_epoch, epochs):
+    print(f"Starting epoch {epoch + 1}")
 
-    iterator = tqdm(training_data_batched)
-    for src_lang, tgt_lang, batch in iterator:
-        loss = training_step(
+    # The resumed epoch goes on with its batches from the saved position
+    if state is not None and state["epoch"] == epoch:
+        training_data_batched = state["training_data_batched"]
+        position = state["position"]
+    elif rank != 0:
+        training_data_batched = broadcast_object(None)
+        position = 0
+    else:
+        training_data_batched = []
+        for (src_lang, trg_lang), data in tokenized_training_data.items():
+            batches = length_bucketed_batches(
+                data, batch_size, bucket_pool_batches, max_batch_tokens
+            )
+            training_data_batched += [(src_lang, trg_lang, batch) for batch in batches]
+            print(
+                f"{src_lang} -> {trg_lang}: padding {padding_fraction(data, batches):.1%}"
+            )
+
+        np.random.shuffle(training_data_batched)
+        training_data_batched = broadcast_object(training_data_batched)
+        position = 0
+
+    # position counts the batches of the shard of this process
+    iterator = tqdm(
+        Prefetcher(
+            shard_batches(training_data_batched, rank, world_size)[position:],
+            prepare_training_batch,
+            prefetch_batches,
+            prefetch_workers,
+        ),
+        disable=rank != 0,
+    )
+    for src_lang, tgt_lang, batch in profiler.batches(iterator):
+        position += 1
+        if lora_adapters is not None:
+            set_lora_adapter(model, lora_adapters[(src_lang, tgt_lang)])
+        loss, tokens = training_step(
             batch,
-            model,
+            training_model,
             tokenizer,
             optimizer,
             lang_to_m2m_lang_id[src_lang],
             lang_to_m2m_lang_id[tgt_lang],
+            profiler,
         )
         total_steps += 1
-        iterator.set_postfix(
-            total_steps=total_steps, loss=loss, src_lang=src_lang, tgt_lang=tgt_lang
-        )
+        if loss_meter.add((src_lang, tgt_lang), loss, tokens, total_steps):
+            iterator.set_postfix(total_steps=total_steps, **loss_meter.postfix())
 
         if total_steps % eval_period == 0 and total_steps != 0:
-            total_eval_loss = 0
-            total_eval_tokens = 0
-
-            for src_lang, tgt_lang, batch in validation_data_batched:
-                loss, tokens = validation_step(
-                    batch,
-                    model,
-                    tokenizer,
-                    lang_to_m2m_lang_id[src_lang],
-                    lang_to_m2m_lang_id[tgt_lang],
-                )
-                total_eval_loss += loss * tokens
-                total_eval_tokens += tokens
-
-            validation_losses[total_steps] = total_eval_loss
-            with open("validation_losses.json", "w") as f:
-                json.dump(validation_losses, f)
-
-            if total_eval_loss < best_eval_loss:
-                print(
-                    f"The model improved! Old loss={best_eval_loss}, new loss={total_eval_loss}"
-                )
-                fname = f"checkpoint_total_steps={total_steps}_loss={total_eval_loss / total_eval_tokens:.2f}"
-                model.save_pretrained(fname)
-                topk_models.append(fname)
-                best_eval_loss = total_eval_loss
-
-                if len(topk_models) > max_models:
-                    fname = topk_models.pop(0)
-                    shutil.rmtree(fname)
-                    print(f"Removing {fname}")
+            if rank == 0:
+                with profiler.stage("validation", "all"):
+                    total_eval_loss, total_eval_tokens = evaluator.evaluate(
+                        quick=quick_eval_size is not None
+                    )
+
+                # Loss per token, comparable between quick and full evaluations
+                eval_loss = total_eval_loss / total_eval_tokens
+                validation_losses[total_steps] = eval_loss
+                with open("validation_losses.json", "w") as f:
+                    json.dump(validation_losses, f)
+
+                if eval_loss < best_eval_loss:
+                    print(
+                        f"The model improved! Old loss={best_eval_loss}, new loss={eval_loss}"
+                    )
+                    fname = f"checkpoint_total_steps={total_steps}_loss={eval_loss:.2f}"
+                    with profiler.stage("checkpoint", "all"):
+                        checkpoints.save_best(model, fname)
+                    best_eval_loss = eval_loss
+
+                with profiler.stage("checkpoint", "all"):
+                    checkpoints.save_state(
+                        model,
+                        optimizer,
+                        total_steps=total_steps,
+                        epoch=epoch,
+                        position=position,
+                        training_data_batched=training_data_batched,
+                        best_eval_loss=best_eval_loss,
+                        validation_losses=validation_losses,
+                    )
+
+            # The other processes wait for rank 0 to validate
+            if world_size > 1:
+                dist.barrier()
+
+    profiler.end_epoch(epoch + 1, total_steps)
 
 # Last check before the end
-total_eval_loss = 0
-total_eval_tokens = 0
-
-for src_lang, tgt_lang, batch in validation_data_batched:
-    loss, tokens = validation_step(
-        batch,
-        model,
-        tokenizer,
-        lang_to_m2m_lang_id[src_lang],
-        lang_to_m2m_lang_id[tgt_lang],
-    )
-    total_eval_loss += loss * tokens
-    total_eval_tokens += tokens
-
-    validation_losses[total_steps] = total_eval_loss
+loss_meter.flush(total_steps)
+if rank == 0:
+    with profiler.stage("validation", "all"):
+        total_eval_loss, total_eval_tokens = evaluator.evaluate()
+
+    # Loss per token, comparable between quick and full evaluations
+    eval_loss = total_eval_loss / total_eval_tokens
+    validation_losses[total_steps] = eval_loss
     with open("validation_losses.json", "w") as f:
         json.dump(validation_losses, f)
 
-    if total_eval_loss < best_eval_loss:
-        print(
-            f"The model improved! Old loss={best_eval_loss}, new loss={total_eval_loss}"
+    if eval_loss < best_eval_loss:
+        print(f"The model improved! Old loss={best_eval_loss}, new loss={eval_loss}")
+        fname = f"checkpoint_total_steps={total_steps}_loss={eval_loss:.2f}"
+        with profiler.stage("checkpoint", "all"):
+            checkpoints.save_best(model, fname)
+        best_eval_loss = eval_loss
+
+    # The final state is marked as finished, it is not resumed
+    with profiler.stage("checkpoint", "all"):
+        checkpoints.save_state(
+            model,
+            optimizer,
+            total_steps=total_steps,
+            epoch=epochs,
+            position=0,
+            training_data_batched=None,
+            best_eval_loss=best_eval_loss,
+            validation_losses=validation_losses,
+            finished=True,
         )
-        fname = f"checkpoint_total_steps={total_steps}_loss={total_eval_loss / total_eval_tokens:.2f}"
-        model.save_pretrained(fname)
-        topk_models.append(fname)
-        best_eval_loss = total_eval_loss
-
-        if len(topk_models) > max_models:
-            fname = topk_models.pop(0)
-            shutil.rmtree(fname)
-            print(f"Removing {fname}")
+        checkpoints.close()
+    profiler.end_epoch("final", total_steps)
+
+if world_size > 1:
+    dist.destroy_process_group()
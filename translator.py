@@ -0,0 +1,415 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import torch
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, LogitsProcessor
+from transformers.modeling_outputs import BaseModelOutput
+
+from utils import batch_it, lang_to_m2m_lang_id
+
+
+# Device used when none is given: the first gpu if available, the cpu otherwise
+def default_device():
+    return torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+
+# Fingerprint of the checkpoint of a model: the files of a local checkpoint (names,
+# sizes and modification times) or the revision of a hub one, so that it changes
+# whenever the checkpoint does
+def model_fingerprint(model, tokenizer=None):
+    path = model.name_or_path
+    parts = [path, getattr(model.config, "_commit_hash", None)]
+    if tokenizer is not None:
+        parts += [tokenizer.name_or_path, len(tokenizer)]
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            stat = os.stat(os.path.join(path, name))
+            parts.append([name, stat.st_size, stat.st_mtime_ns])
+
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+# The model with its linear layers dynamically quantized to int8 (weights stored in
+# int8, activations quantized on the fly), for faster inference on the cpu
+def quantize_model(model):
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+# Cache of translations, addressed by the hash of model fingerprint, languages,
+# decoding settings and normalized input (see Translator.translate_many). The least
+# recently used entries are kept in memory up to max_entries and, with a path, on
+# disk up to max_disk_entries. It can be shared by more threads
+class TranslationCache:
+    def __init__(self, max_entries=10_000, path=None, max_disk_entries=1_000_000):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.connection = None
+        if path is not None:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS translations "
+                "(key BLOB PRIMARY KEY, value TEXT NOT NULL, used INTEGER NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS translations_used ON translations (used)"
+            )
+            self.clock = self.connection.execute(
+                "SELECT COALESCE(MAX(used), 0) FROM translations"
+            ).fetchone()[0]
+
+    @staticmethod
+    def key(fingerprint, src_lang, tgt_lang, settings, text):
+        return hashlib.sha256(
+            f"{fingerprint}\0{src_lang}\0{tgt_lang}\0{settings}\0{text}".encode()
+        ).digest()
+
+    # Dict of the cached key -> translation among the requested keys
+    def get_many(self, keys, query_size=500):
+        keys = set(keys)
+        with self.lock:
+            found = {}
+            for key in keys:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[key] = self.memory[key]
+            self.memory_hits += len(found)
+
+            missing = [key for key in keys if key not in found]
+            if self.connection is not None and missing:
+                disk_found = {}
+                for i in range(0, len(missing), query_size):
+                    batch = missing[i : i + query_size]
+                    rows = self.connection.execute(
+                        "SELECT key, value FROM translations WHERE key IN "
+                        f"({','.join('?' * len(batch))})",
+                        batch,
+                    )
+                    disk_found.update(rows)
+
+                self.clock += 1
+                self.connection.executemany(
+                    "UPDATE translations SET used = ? WHERE key = ?",
+                    [(self.clock, key) for key in disk_found],
+                )
+                self.connection.commit()
+
+                self.disk_hits += len(disk_found)
+                self._put_memory(disk_found.items())
+                found.update(disk_found)
+
+            self.misses += len(keys) - len(found)
+            return found
+
+    # items are (key, translation) pairs
+    def put_many(self, items):
+        items = list(items)
+        with self.lock:
+            self._put_memory(items)
+            if self.connection is None:
+                return
+
+            self.clock += 1
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO translations (key, value, used) VALUES (?, ?, ?)",
+                [(key, value, self.clock) for key, value in items],
+            )
+            (count,) = self.connection.execute(
+                "SELECT COUNT(*) FROM translations"
+            ).fetchone()
+            excess = count - self.max_disk_entries
+            if excess > 0:
+                self.connection.execute(
+                    "DELETE FROM translations WHERE key IN "
+                    "(SELECT key FROM translations ORDER BY used LIMIT ?)",
+                    (excess,),
+                )
+            self.connection.commit()
+
+    def _put_memory(self, items):
+        for key, value in items:
+            self.memory[key] = value
+            self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        requests = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "requests": requests,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (
+                (self.memory_hits + self.disk_hits) / requests if requests else 0.0
+            ),
+            "memory_entries": len(self.memory),
+        }
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+# Named decoding settings, given as preset to Translator or to its calls (the other
+# arguments override them, the preset of a call replaces the one of the Translator).
+# The translation of every sentence can be max_length_ratio times as long as the
+# sentence, plus max_length_offset tokens (end of sentence included), whatever the
+# other sentences of its batch
+DECODING_PRESETS = {
+    "greedy": {"num_beams": 1, "max_length_ratio": 2.0, "max_length_offset": 10},
+    "small_beam": {
+        "num_beams": 4,
+        "early_stopping": True,
+        "max_length_ratio": 2.0,
+        "max_length_offset": 10,
+    },
+    "full_beam": {
+        "num_beams": 10,
+        "early_stopping": True,
+        "max_length_ratio": 2.0,
+        "max_length_offset": 10,
+    },
+}
+
+
+# The decoding arguments with their preset (if any) expanded
+def decoding_settings(generate_kwargs):
+    generate_kwargs = dict(generate_kwargs)
+    preset = generate_kwargs.pop("preset", None)
+    if preset is None:
+        return generate_kwargs
+    if preset not in DECODING_PRESETS:
+        raise ValueError(
+            f"Unknown decoding preset `{preset}`, use one of {list(DECODING_PRESETS)}"
+        )
+    return {**DECODING_PRESETS[preset], **generate_kwargs}
+
+
+# Force the end of sentence on the sentences of the batch reaching their own
+# maximum length (max_lengths, in generated tokens, for each sentence in turn)
+class MaxLengthPerSentenceLogitsProcessor(LogitsProcessor):
+    def __init__(self, max_lengths, eos_token_id):
+        self.max_lengths = torch.tensor(max_lengths)
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids, scores):
+        # input_ids holds the decoder start token and the generated tokens, the
+        # first of which (the language token) is forced
+        if input_ids.shape[-1] == 1:
+            return scores
+
+        max_lengths = self.max_lengths.to(scores.device).repeat_interleave(
+            scores.shape[0] // len(self.max_lengths)
+        )
+        ended = input_ids.shape[-1] >= max_lengths
+        scores[ended] = -float("inf")
+        scores[ended, self.eos_token_id] = 0
+        return scores
+
+
+# Force the first generated token of every sentence of the batch to its own token
+# (as forced_bos_token_id does with one token for the whole batch), so that one
+# generate call decodes the same sentences into different languages
+class ForcedBOSPerSentenceLogitsProcessor(LogitsProcessor):
+    def __init__(self, bos_token_ids):
+        self.bos_token_ids = torch.tensor(bos_token_ids)
+
+    def __call__(self, input_ids, scores):
+        if input_ids.shape[-1] != 1:
+            return scores
+
+        # The rows of scores are the beams (or samples) of every sentence in turn
+        bos_token_ids = self.bos_token_ids.to(scores.device).repeat_interleave(
+            scores.shape[0] // len(self.bos_token_ids)
+        )
+        forced_scores = torch.full_like(scores, -float("inf"))
+        forced_scores[torch.arange(scores.shape[0]), bos_token_ids] = 0
+        return forced_scores
+
+
+# Model and tokenizer loaded once, translating lists of sentences between the
+# languages of lang_to_m2m_lang_id (ea, tnt, de, en, lKey, wordClass).
+# The languages are given to every call and never set on the tokenizer, so the
+# same Translator can serve more threads at once. With quantize, the model runs on
+# the cpu with int8 linear layers (see quantize_model)
+class Translator:
+    def __init__(
+        self,
+        model_path,
+        tokenizer_path=None,
+        device=None,
+        batch_size=32,
+        cache=None,
+        quantize=False,
+        **generate_kwargs,
+    ):
+        if quantize:
+            if device is not None and torch.device(device).type != "cpu":
+                raise ValueError("Quantized models run on the cpu only")
+            device = "cpu"
+        self.device = torch.device(device) if device is not None else default_device()
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_path or model_path)
+        self.model = (
+            AutoModelForSeq2SeqLM.from_pretrained(model_path).to(self.device).eval()
+        )
+        self.batch_size = batch_size
+        # Optional TranslationCache, invalidated by a change of the checkpoint
+        self.cache = cache
+        self.fingerprint = model_fingerprint(self.model, self.tokenizer)
+        self.quantized = quantize
+        if quantize:
+            self.model = quantize_model(self.model)
+            self.fingerprint += "-int8"
+        # Default arguments of model.generate (e.g. num_beams or a preset of
+        # DECODING_PRESETS), overridable per call
+        decoding_settings(generate_kwargs)
+        self.generate_kwargs = generate_kwargs
+
+    def lang_id(self, lang):
+        return self.tokenizer.get_lang_id(lang_to_m2m_lang_id[lang])
+
+    # Token ids of the sentences, as given by the tokenizer with src_lang set:
+    # language token, sentence tokens, end of sentence
+    def encode(self, sentences, src_lang):
+        input_ids = self.tokenizer(list(sentences), add_special_tokens=False)[
+            "input_ids"
+        ]
+        return [
+            [self.lang_id(src_lang)] + ids + [self.tokenizer.eos_token_id]
+            for ids in input_ids
+        ]
+
+    # Padded batch of token ids on the device
+    def pad(self, input_ids):
+        return self.tokenizer.pad({"input_ids": input_ids}, return_tensors="pt").to(
+            self.device
+        )
+
+    # Translations of the sentences, generated in batches of batch_size sentences of
+    # similar length and returned in the order of the sentences
+    def translate(
+        self, sentences, src_lang, tgt_lang, batch_size=None, **generate_kwargs
+    ):
+        return self.translate_many(
+            sentences, src_lang, [tgt_lang], batch_size, **generate_kwargs
+        )[tgt_lang]
+
+    # Translations of the sentences in every language of tgt_langs
+    # ({tgt_lang: translations}). With a cache, the sentences are normalized
+    # (whitespace collapsed) and only those missing in the cache for some language
+    # are translated, each once
+    def translate_many(
+        self, sentences, src_lang, tgt_langs, batch_size=None, **generate_kwargs
+    ):
+        generate_kwargs = decoding_settings({**self.generate_kwargs, **generate_kwargs})
+        if self.cache is None:
+            return self._generate_many(
+                sentences, src_lang, tgt_langs, batch_size, **generate_kwargs
+            )
+
+        settings = json.dumps(generate_kwargs, sort_keys=True, default=str)
+        texts = [" ".join(sentence.split()) for sentence in sentences]
+        keys = {
+            (tgt_lang, text): self.cache.key(
+                self.fingerprint, src_lang, tgt_lang, settings, text
+            )
+            for tgt_lang in tgt_langs
+            for text in set(texts)
+        }
+        found = self.cache.get_many(keys.values())
+
+        missing = sorted(
+            {text for (tgt_lang, text), key in keys.items() if key not in found}
+        )
+        if missing:
+            generated = self._generate_many(
+                missing, src_lang, tgt_langs, batch_size, **generate_kwargs
+            )
+            new_items = [
+                (keys[(tgt_lang, text)], translation)
+                for tgt_lang, translations in generated.items()
+                for text, translation in zip(missing, translations)
+            ]
+            self.cache.put_many(new_items)
+            found.update(new_items)
+
+        return {
+            tgt_lang: [found[keys[(tgt_lang, text)]] for text in texts]
+            for tgt_lang in tgt_langs
+        }
+
+    # Translations of the sentences in every language of tgt_langs, without cache:
+    # every batch is encoded once and decoded into all the languages by one
+    # generate call
+    def _generate_many(
+        self, sentences, src_lang, tgt_langs, batch_size=None, **generate_kwargs
+    ):
+        input_ids = self.encode(sentences, src_lang)
+        order = sorted(range(len(input_ids)), key=lambda i: len(input_ids[i]))
+        max_length_ratio = generate_kwargs.pop("max_length_ratio", None)
+        max_length_offset = generate_kwargs.pop("max_length_offset", 0)
+
+        translations = {tgt_lang: [None] * len(input_ids) for tgt_lang in tgt_langs}
+        with torch.no_grad(), torch.autocast(
+            self.device.type, enabled=self.device.type == "cuda"
+        ):
+            for batch in batch_it(order, batch_size or self.batch_size):
+                model_inputs = self.pad([input_ids[i] for i in batch])
+                logits_processor = [
+                    ForcedBOSPerSentenceLogitsProcessor(
+                        [
+                            self.lang_id(tgt_lang)
+                            for tgt_lang in tgt_langs
+                            for _ in batch
+                        ]
+                    )
+                ]
+                if max_length_ratio is not None:
+                    max_lengths = [
+                        int(max_length_ratio * len(input_ids[i])) + max_length_offset
+                        for i in batch
+                    ]
+                    generate_kwargs["max_new_tokens"] = max(max_lengths)
+                    logits_processor.append(
+                        MaxLengthPerSentenceLogitsProcessor(
+                            max_lengths * len(tgt_langs), self.tokenizer.eos_token_id
+                        )
+                    )
+                encoder_outputs = self.model.get_encoder()(**model_inputs)
+
+                # The batch repeated for every language, one after the other
+                generated_tokens = self.model.generate(
+                    encoder_outputs=BaseModelOutput(
+                        last_hidden_state=encoder_outputs.last_hidden_state.repeat(
+                            len(tgt_langs), 1, 1
+                        )
+                    ),
+                    attention_mask=model_inputs["attention_mask"].repeat(
+                        len(tgt_langs), 1
+                    ),
+                    logits_processor=logits_processor,
+                    **generate_kwargs,
+                )
+                # The first (best) of the sequences returned for each sentence
+                decoded = self.tokenizer.batch_decode(
+                    generated_tokens, skip_special_tokens=True
+                )[:: len(generated_tokens) // (len(tgt_langs) * len(batch))]
+                for k, tgt_lang in enumerate(tgt_langs):
+                    for i, translation in zip(
+                        batch, decoded[k * len(batch) : (k + 1) * len(batch)]
+                    ):
+                        translations[tgt_lang][i] = translation
+
+        return translations
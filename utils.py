@@ -1,8 +1,29 @@
+import hashlib
 import json
+import multiprocessing
 import os
+import random
 import re
-
+import shutil
+import sys
+import time
+from array import array
+from collections import defaultdict, deque
+from collections.abc import MutableSequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
 import torch
+import torch.distributed as dist
+
+try:
+    import resource
+except ImportError:
+    resource = None
+from transformers import BatchEncoding
+
+import cleaning
 
 lang_to_m2m_lang_id = {
     "ea": "ar",
@@ -17,186 +38,299 @@ lang_to_m2m_lang_id = {
 
 
 # load all files from folder
-def load_data_from_folder(folder):
-    data = []
+def load_data_from_folder(folder, keep=None):
     files = os.listdir(folder)
     print(f"Ci sono {len(files)} files.")
 
-    for fname in files:
-        if fname.endswith(".json"):
-            with open(os.path.join(folder, fname), encoding="utf-8") as f:
-                data += json.load(f)
+    data = list(iter_data_from_folder(folder, keep))
 
     print(f"Caricati {len(data)} datapoints.")
 
     return data
 
 
-def extract_data_standard(data, src_lang, tgt_lang):
-    # Filter data without ae -> target
-    data = filter(
+# Yield the datapoints of all .json (array) and .jsonl files in folder, one by one,
+# skipping the ones for which keep(datapoint) is false
+def iter_data_from_folder(folder, keep=None):
+    for fname in os.listdir(folder):
+        if fname.endswith(".json"):
+            iter_file = iter_json_array
+        elif fname.endswith(".jsonl"):
+            iter_file = iter_json_lines
+        else:
+            continue
+
+        with open(os.path.join(folder, fname), encoding="utf-8") as f:
+            for datapoint in iter_file(f):
+                if keep is None or keep(datapoint):
+                    yield datapoint
+
+
+def iter_json_lines(f):
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+# Decode the elements of a top-level JSON array one at a time, reading the file in
+# chunks instead of loading it all
+def iter_json_array(f, read_size=1 << 20):
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    eof = False
+
+    def next_char():
+        nonlocal buffer, position, eof
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer) or eof:
+                return buffer[position] if position < len(buffer) else ""
+            buffer, position = f.read(read_size), 0
+            eof = buffer == ""
+
+    if next_char() != "[":
+        raise ValueError("Expected a JSON array")
+    position += 1
+
+    if next_char() == "]":
+        return
+
+    while True:
+        try:
+            element, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            end = None
+
+        # The element could continue in the next chunk: it is complete once the
+        # separator after it is read (a number like 12. or 1e is a valid prefix)
+        if end is not None:
+            after = end
+            while after < len(buffer) and buffer[after].isspace():
+                after += 1
+        if not eof and (
+            end is None or after == len(buffer) or buffer[after] not in ",]"
+        ):
+            chunk = f.read(read_size)
+            eof = chunk == ""
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+
+        yield element
+        position = end
+
+        separator = next_char()
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ValueError("Expected ',' or ']' in the JSON array")
+        position += 1
+        next_char()
+
+
+# Metadata dicts shared by the PairData of a dataset, each one stored once
+class MetadataTable:
+    def __init__(self):
+        self.metadata = []
+        self.indices = {}
+        self.derived = {}
+
+    def index(self, metadata):
+        index = self.indices.get(id(metadata))
+        if index is None:
+            index = self.indices[id(metadata)] = len(self.metadata)
+            self.metadata.append(metadata)
+        return index
+
+    # Copy of metadata with some changed values, made once per metadata and changes
+    def derive(self, metadata, **changes):
+        key = (id(metadata), tuple(sorted(changes.items())))
+        if key not in self.derived:
+            self.derived[key] = {**metadata, **changes}
+        return self.derived[key]
+
+
+# Columnar list of {"source": ..., "target": ..., "metadata": ...} examples: sources
+# and targets are interned strings, metadata an index in the MetadataTable. Examples
+# are built on access, and assigning one back (e.g. np.random.shuffle) only moves
+# references
+class PairData(MutableSequence):
+    def __init__(self, metadata_table=None, examples=()):
+        self.metadata_table = metadata_table or MetadataTable()
+        self.sources = []
+        self.targets = []
+        self.metadata = array("l")
+        self.extend(examples)
+
+    def add(self, source, target, metadata):
+        self.sources.append(sys.intern(source))
+        self.targets.append(sys.intern(target))
+        self.metadata.append(self.metadata_table.index(metadata))
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        return {
+            "source": self.sources[i],
+            "target": self.targets[i],
+            "metadata": self.metadata_table.metadata[self.metadata[i]],
+        }
+
+    def __setitem__(self, i, example):
+        if isinstance(i, slice):
+            raise TypeError("PairData does not support slice assignment")
+
+        self.sources[i] = sys.intern(example["source"])
+        self.targets[i] = sys.intern(example["target"])
+        self.metadata[i] = self.metadata_table.index(example["metadata"])
+
+    def __delitem__(self, i):
+        del self.sources[i]
+        del self.targets[i]
+        del self.metadata[i]
+
+    def insert(self, i, example):
+        self.sources.insert(i, sys.intern(example["source"]))
+        self.targets.insert(i, sys.intern(example["target"]))
+        self.metadata.insert(i, self.metadata_table.index(example["metadata"]))
+
+
+# (src_lang, tgt_lang) -> (source field, target field, filter) of every extracted
+# pair, the filters drop datapoints without source or target
+extracted_pairs = {
+    # ea -> traduction
+    ("ea", "de"): (
+        "source",
+        "target",
         lambda datapoint: (
-            datapoint["metadata"]["source_lang"] == src_lang
-            and datapoint["metadata"]["target_lang"] == tgt_lang
+            datapoint["metadata"]["source_lang"] == "ea"
+            and datapoint["metadata"]["target_lang"] == "de"
             and datapoint["source"] != ""
             and datapoint["target"] != ""
         ),
-        data,
-    )
-
-    data = map(
-        lambda datapoint: {
-            "source": datapoint["source"],
-            "target": datapoint["target"],
-            "metadata": datapoint["metadata"],
-        },
-        data,
-    )
-
-    data = list(data)
-
-    print(f"{src_lang} -> {tgt_lang}: Dopo i filtri abbiamo {len(data)} datapoints.")
-    return data
-
-
-# Extract ea as source and transliteration as target
-def extract_data_transliteration_target(data, src_lang):
-    # Filter data without ae -> transliteration
-    data = filter(
+    ),
+    ("ea", "en"): (
+        "source",
+        "target",
         lambda datapoint: (
-            datapoint["metadata"]["source_lang"] == src_lang
+            datapoint["metadata"]["source_lang"] == "ea"
+            and datapoint["metadata"]["target_lang"] == "en"
             and datapoint["source"] != ""
-            and datapoint["transliteration"] != ""
+            and datapoint["target"] != ""
         ),
-        data,
-    )
-
-    data = map(
-        lambda datapoint: {
-            "source": datapoint["source"],
-            "target": datapoint["transliteration"],
-            "metadata": datapoint["metadata"],
-        },
-        data,
-    )
-
-    data = list(data)
-
-    print(f"{src_lang} -> tnt: Dopo i filtri abbiamo {len(data)} datapoints.")
-    return data
-
-
-# Extract transliteration as source and traduction as target
-def extract_data_transliteration_source(data, trg_lang):
-    # Filter data without traduction -> transliteration
-    data = filter(
+    ),
+    # ea -> transliteration
+    ("ea", "tnt"): (
+        "source",
+        "transliteration",
         lambda datapoint: (
-            datapoint["metadata"]["target_lang"] == trg_lang
-            and datapoint["target"] != ""
+            datapoint["metadata"]["source_lang"] == "ea"
+            and datapoint["source"] != ""
             and datapoint["transliteration"] != ""
         ),
-        data,
-    )
-
-    data = map(
-        lambda datapoint: {
-            "source": datapoint["transliteration"],
-            "target": datapoint["target"],
-            "metadata": datapoint["metadata"],
-        },
-        data,
-    )
-
-    data = list(data)
-
-    print(f"tnt -> {trg_lang}: Dopo i filtri abbiamo {len(data)} datapoints.")
-    return data
-
-
-# Extract ea as source and lKey/wordClass as target
-def extract_data_ea_lKey_or_wordClass(data, lKey_or_wordClass):
-    assert lKey_or_wordClass in ("lKey", "wordClass")
-
-    # Filter data without ae -> lKey_or_wordClass
-    data = filter(
+    ),
+    # ea -> lKey/wordClass
+    ("ea", "lKey"): (
+        "source",
+        "lKey",
         lambda datapoint: (
             datapoint["metadata"]["source_lang"] == "ea"
             and datapoint["source"] != ""
-            and datapoint[lKey_or_wordClass] != ""
-            and "/" not in datapoint[lKey_or_wordClass]
+            and datapoint["lKey"] != ""
+            and "/" not in datapoint["lKey"]
         ),
-        data,
-    )
-
-    data = map(
-        lambda datapoint: {
-            "source": datapoint["source"],
-            "target": datapoint[lKey_or_wordClass],
-            "metadata": datapoint["metadata"],
-        },
-        data,
-    )
-
-    data = list(data)
-
-    print(f"ea -> {lKey_or_wordClass}: Dopo i filtri abbiamo {len(data)} datapoints.")
-    return data
-
-
-# Extract transliteration as source and lKey/wordClass as target
-def extract_data_transliteration_lKey_or_wordClass(data, lKey_or_wordClass):
-    assert lKey_or_wordClass in ("lKey", "wordClass")
-
-    # Filter data without tnt -> lKey_or_wordClass
-    data = filter(
+    ),
+    ("ea", "wordClass"): (
+        "source",
+        "wordClass",
+        lambda datapoint: (
+            datapoint["metadata"]["source_lang"] == "ea"
+            and datapoint["source"] != ""
+            and datapoint["wordClass"] != ""
+            and "/" not in datapoint["wordClass"]
+        ),
+    ),
+    # transliteration -> traduction
+    ("tnt", "de"): (
+        "transliteration",
+        "target",
+        lambda datapoint: (
+            datapoint["metadata"]["target_lang"] == "de"
+            and datapoint["target"] != ""
+            and datapoint["transliteration"] != ""
+        ),
+    ),
+    ("tnt", "en"): (
+        "transliteration",
+        "target",
+        lambda datapoint: (
+            datapoint["metadata"]["target_lang"] == "en"
+            and datapoint["target"] != ""
+            and datapoint["transliteration"] != ""
+        ),
+    ),
+    # transliteration -> lKey/wordClass
+    ("tnt", "lKey"): (
+        "transliteration",
+        "lKey",
         lambda datapoint: (
             datapoint["transliteration"] != ""
-            and datapoint[lKey_or_wordClass] != ""
-            and "/" not in datapoint[lKey_or_wordClass]
+            and datapoint["lKey"] != ""
+            and "/" not in datapoint["lKey"]
         ),
-        data,
-    )
-
-    data = map(
-        lambda datapoint: {
-            "source": datapoint["transliteration"],
-            "target": datapoint[lKey_or_wordClass],
-            "metadata": datapoint["metadata"],
-        },
-        data,
-    )
+    ),
+    ("tnt", "wordClass"): (
+        "transliteration",
+        "wordClass",
+        lambda datapoint: (
+            datapoint["transliteration"] != ""
+            and datapoint["wordClass"] != ""
+            and "/" not in datapoint["wordClass"]
+        ),
+    ),
+}
 
-    data = list(data)
 
-    print(f"tnt -> {lKey_or_wordClass}: Dopo i filtri abbiamo {len(data)} datapoints.")
-    return data
+# Processing data: a single pass sends every datapoint to all the pairs it
+# qualifies for, only the requested pairs (all by default) are extracted
+def processed_data(data, pairs=None):
+    metadata_table = MetadataTable()
+    routes = [
+        (pair, *extracted_pairs[pair], PairData(metadata_table))
+        for pair in extracted_pairs
+        if pairs is None or pair in pairs
+    ]
 
+    for datapoint in data:
+        for _, source_field, target_field, keep, extracted in routes:
+            if keep(datapoint):
+                extracted.add(
+                    datapoint[source_field],
+                    datapoint[target_field],
+                    datapoint["metadata"],
+                )
+
+    processed = {}
+    for (src_lang, tgt_lang), _, _, _, extracted in routes:
+        print(
+            f"{src_lang} -> {tgt_lang}: Dopo i filtri abbiamo {len(extracted)} datapoints."
+        )
+        processed.setdefault(src_lang, {})[tgt_lang] = extracted
 
-# Processing data
-def processed_data(data):
-    return {
-        "ea": {
-            "de": extract_data_standard(data, "ea", "de"),
-            "en": extract_data_standard(data, "ea", "en"),
-            "tnt": extract_data_transliteration_target(data, "ea"),
-            "lKey": extract_data_ea_lKey_or_wordClass(data, "lKey"),
-            "wordClass": extract_data_ea_lKey_or_wordClass(data, "wordClass"),
-        },
-        "tnt": {
-            "de": extract_data_transliteration_source(data, "de"),
-            "en": extract_data_transliteration_source(data, "en"),
-            "lKey": extract_data_transliteration_lKey_or_wordClass(data, "lKey"),
-            "wordClass": extract_data_transliteration_lKey_or_wordClass(
-                data, "wordClass"
-            ),
-        },
-    }
+    return processed
 
 
 # Cleaning functions defining
 
 
-# Hieroglyphs cleaning
+# Hieroglyphs cleaning (reference version of cleaning.clean_graphics)
 def clean_graphics(text: str) -> str:
     # Start from double spaces and sentences to delete
     text = " ".join(text.split())
@@ -310,7 +444,7 @@ def clean_graphics(text: str) -> str:
     return text
 
 
-# Traduction cleaning
+# Traduction cleaning (reference version of cleaning.clean_traduction)
 def clean_traduction(text):
     # Start from double spaces and sentences to delete
     text = " ".join(text.split())
@@ -456,7 +590,7 @@ def clean_traduction(text):
     return text
 
 
-# Transliteration cleaning
+# Transliteration cleaning (reference version of cleaning.clean_wChar)
 def clean_wChar(text):
     # Start from double spaces and sentences to delete
     text = " ".join(text.split())
@@ -640,14 +774,77 @@ def clean_wChar(text):
 #     return text
 
 
-# Clean all data function
-def clean_data(data):
-    for datapoint in data:
-        datapoint["source"] = clean_graphics(datapoint["source"])
-        datapoint["transliteration"] = clean_wChar(datapoint["transliteration"])
-        datapoint["target"] = clean_traduction(datapoint["target"])
-        # datapoint['wordClass'] = clean_wordClass(datapoint['wordClass'])
-    return data
+# Datapoint fields cleaned by clean_data and the cleaner used for each one
+cleaned_fields = {
+    "source": "graphics",
+    "transliteration": "wChar",
+    "target": "traduction",
+    # "wordClass": "wordClass",
+}
+
+
+# Clean a chunk of (cleaner kind, text) pairs
+def clean_texts(chunk):
+    return [cleaning.cleaners[kind](text) for kind, text in chunk]
+
+
+# Clean a block of datapoints in place: every distinct text is cleaned once, and
+# texts in the cache are not cleaned again
+def clean_block(block, pool=None, chunk_size=1000, cache=None):
+    texts = [
+        (kind, datapoint[field])
+        for datapoint in block
+        for field, kind in cleaned_fields.items()
+    ]
+    cleaned = {} if cache is None else cache.get_many(texts)
+    missing = [text for text in dict.fromkeys(texts) if text not in cleaned]
+
+    if pool is None:
+        values = clean_texts(missing)
+    else:
+        values = [
+            value
+            for chunk in pool.imap(clean_texts, batch_it(missing, chunk_size))
+            for value in chunk
+        ]
+
+    cleaned.update(zip(missing, values))
+    if cache is not None:
+        cache.put_many(zip(missing, values))
+
+    for datapoint in block:
+        for field, kind in cleaned_fields.items():
+            datapoint[field] = cleaned[(kind, datapoint[field])]
+
+
+# Clean all data function: data can be any iterable of datapoints (e.g. from
+# iter_data_from_folder), consumed in blocks of block_size, and the cleaned
+# datapoints are yielded block by block, so that only one block is held at a time
+# (e.g. streaming into processed_data). With num_workers > 1 chunks of texts are
+# cleaned by a process pool
+def clean_data(data, num_workers=1, chunk_size=1000, cache=None, block_size=100_000):
+    if num_workers > 1:
+        # fork doesn't re-run the training script in the workers
+        context = multiprocessing.get_context(
+            "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+        )
+        pool = context.Pool(num_workers)
+    else:
+        pool = None
+
+    count = 0
+    try:
+        for block in batch_it(data, block_size):
+            clean_block(block, pool, chunk_size, cache)
+            count += len(block)
+            yield from block
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    print(f"Caricati {count} datapoints.")
+    if cache is not None:
+        print(f"Cache: {cache.hits} hit, {cache.misses} miss.")
 
 
 # Training functions defining: batch_it, tokenize_batch, training_stes, validations_step
@@ -669,6 +866,12 @@ def batch_it(sequence, batch_size=1, return_last=True):
 
 
 def tokenize_batch(model, batch, tokenizer, src_lang, tgt_lang):
+    # Batches collated by TokenizedPairData are already tokenized
+    if isinstance(batch, BatchEncoding):
+        # Models wrapped by DistributedDataParallel are in model.module
+        device = getattr(model, "module", model).device
+        return batch.to(device, non_blocking=True)
+
     tokenizer.src_lang = src_lang
     tokenizer.tgt_lang = tgt_lang
 
@@ -690,18 +893,497 @@ def tokenize_batch(model, batch, tokenizer, src_lang, tgt_lang):
     return tokenized_batch
 
 
-def training_step(batch, model, tokenizer, optimizer, src_lang, tgt_lang):
-    with torch.cuda.amp.autocast():
-        tokenized_batch = tokenize_batch(model, batch, tokenizer, src_lang, tgt_lang)
-        loss = model(**tokenized_batch).loss
+# Pre-tokenized examples of a pair: the token ids of all sources (targets) are
+# concatenated in a memory-mapped file, and example i is ids[offsets[i]:offsets[i + 1]]
+class TokenizedPairData:
+    def __init__(self, path):
+        with open(os.path.join(path, "info.json"), encoding="utf-8") as f:
+            self.info = json.load(f)
+
+        self.source_ids, self.source_offsets, self.target_ids, self.target_offsets = (
+            (
+                np.memmap(os.path.join(path, fname), dtype=dtype, mode="r")
+                if os.path.getsize(os.path.join(path, fname)) > 0
+                else np.zeros(0, dtype=dtype)
+            )
+            for fname, dtype in (
+                ("source_ids.bin", np.int32),
+                ("source_offsets.bin", np.int64),
+                ("target_ids.bin", np.int32),
+                ("target_offsets.bin", np.int64),
+            )
+        )
+
+    def __len__(self):
+        return len(self.source_offsets) - 1
+
+    @property
+    def source_lengths(self):
+        return np.diff(self.source_offsets)
+
+    @property
+    def target_lengths(self):
+        return np.diff(self.target_offsets)
+
+    # Padded input_ids, attention_mask and labels (-100 on padding) of the examples
+    def collate(self, indices, pin_memory=False):
+        input_ids, attention_mask = self._pad(
+            self.source_ids, self.source_offsets, indices, self.info["pad_token_id"]
+        )
+        labels, _ = self._pad(self.target_ids, self.target_offsets, indices, -100)
+
+        tensors = {
+            "input_ids": torch.from_numpy(input_ids),
+            "attention_mask": torch.from_numpy(attention_mask),
+            "labels": torch.from_numpy(labels),
+        }
+        # Pinned tensors are copied to the GPU without blocking the training step
+        if pin_memory:
+            tensors = {name: tensor.pin_memory() for name, tensor in tensors.items()}
+
+        return BatchEncoding(tensors)
+
+    def _pad(self, ids, offsets, indices, pad_id):
+        starts = offsets[indices]
+        lengths = offsets[np.asarray(indices) + 1] - starts
+        padded = np.full((len(indices), lengths.max(initial=0)), pad_id, dtype=np.int64)
+        mask = np.zeros(padded.shape, dtype=np.int64)
+
+        for row, (start, length) in enumerate(zip(starts, lengths)):
+            if self.info["padding_side"] == "left":
+                columns = slice(padded.shape[1] - length, None)
+            else:
+                columns = slice(0, length)
+            padded[row, columns] = ids[start : start + length]
+            mask[row, columns] = 1
+
+        return padded, mask
+
+
+# Tokenize the examples of a pair once and store them in cache_dir, keyed by the
+# tokenizer, the languages, max_length and the examples themselves. The cache is
+# read-only once written, so more jobs can share it
+def tokenize_pair_data(
+    data,
+    tokenizer,
+    src_lang,
+    tgt_lang,
+    max_length=64,
+    cache_dir="tokenized_cache",
+    chunk_size=1000,
+):
+    digest = hashlib.sha256(
+        json.dumps(
+            [
+                type(tokenizer).__name__,
+                tokenizer.name_or_path,
+                len(tokenizer),
+                src_lang,
+                tgt_lang,
+                max_length,
+            ]
+        ).encode()
+    )
+    for element in data:
+        digest.update(f"{element['source']}\0{element['target']}\0".encode())
+    path = os.path.join(cache_dir, digest.hexdigest())
+
+    if not os.path.exists(path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+
+        tokenizer.src_lang = src_lang
+        tokenizer.tgt_lang = tgt_lang
+        offsets = {"source": array("q", [0]), "target": array("q", [0])}
+
+        with open(os.path.join(tmp_path, "source_ids.bin"), "wb") as source_file, open(
+            os.path.join(tmp_path, "target_ids.bin"), "wb"
+        ) as target_file:
+            for batch in batch_it(data, chunk_size):
+                tokenized_batch = tokenizer(
+                    [element["source"] for element in batch],
+                    text_target=[element["target"] for element in batch],
+                    max_length=max_length,
+                    truncation=True,
+                )
+                for key, f, name in (
+                    ("input_ids", source_file, "source"),
+                    ("labels", target_file, "target"),
+                ):
+                    for ids in tokenized_batch[key]:
+                        array("i", ids).tofile(f)
+                        offsets[name].append(offsets[name][-1] + len(ids))
+
+        for name, name_offsets in offsets.items():
+            with open(os.path.join(tmp_path, f"{name}_offsets.bin"), "wb") as f:
+                name_offsets.tofile(f)
+        with open(os.path.join(tmp_path, "info.json"), "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "pad_token_id": tokenizer.pad_token_id,
+                    "padding_side": tokenizer.padding_side,
+                    "src_lang": src_lang,
+                    "tgt_lang": tgt_lang,
+                    "max_length": max_length,
+                },
+                f,
+            )
+
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another job wrote the same cache in the meantime
+            shutil.rmtree(tmp_path)
+
+    return TokenizedPairData(path)
+
+
+# Iterate prepare(item) for the items, in order, while worker threads prepare
+# the next depth items. Leaving the loop (end, break or error) cancels the
+# pending items and joins the workers
+class Prefetcher:
+    def __init__(self, items, prepare, depth=4, num_workers=1):
+        self.items = items
+        self.prepare = prepare
+        self.depth = depth
+        self.num_workers = num_workers
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        executor = ThreadPoolExecutor(self.num_workers)
+        pending = deque()
+        try:
+            for item in self.items:
+                pending.append(executor.submit(self.prepare, item))
+                if len(pending) > self.depth:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+# Cut the examples, in the given order, into batches of batch_size examples and,
+# with max_tokens, of at most max_tokens padded source+target tokens
+def cut_batches(data, indices, batch_size, max_tokens=None):
+    if max_tokens is None:
+        return [
+            indices[i : i + batch_size].tolist()
+            for i in range(0, len(indices), batch_size)
+        ]
+
+    source_lengths, target_lengths = data.source_lengths, data.target_lengths
+    batches = []
+    batch = []
+    max_source = max_target = 0
+    for index in indices.tolist():
+        source = max(max_source, source_lengths[index])
+        target = max(max_target, target_lengths[index])
+        # A batch holds at least one example, even if longer than max_tokens
+        if batch and (
+            len(batch) == batch_size
+            or (len(batch) + 1) * (source + target) > max_tokens
+        ):
+            batches.append(batch)
+            batch = []
+            source, target = source_lengths[index], target_lengths[index]
+        batch.append(index)
+        max_source, max_target = source, target
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+# Indices of the examples sorted by (source, target) length
+def length_order(data, indices=None):
+    if indices is None:
+        indices = np.arange(len(data))
+
+    return indices[
+        np.lexsort((data.target_lengths[indices], data.source_lengths[indices]))
+    ]
+
+
+# Batches of examples with similar length: the shuffled examples are split in pools
+# of pool_batches * batch_size examples, sorted by length and cut into batches.
+# The pools keep the batches random, shuffling the returned list mixes them
+def length_bucketed_batches(data, batch_size, pool_batches=50, max_tokens=None):
+    order = np.random.permutation(len(data))
+    pool_size = batch_size * pool_batches
+
+    batches = []
+    for start in range(0, len(order), pool_size):
+        pool = length_order(data, order[start : start + pool_size])
+        batches += cut_batches(data, pool, batch_size, max_tokens)
 
-        loss.backward()
-        optimizer.step()
-        optimizer.zero_grad()
+    return batches
 
-        return loss.item()
 
+# Fraction of padding tokens (sources and targets) in the batches of a pair
+def padding_fraction(data, batches):
+    padded_tokens = 0
+    real_tokens = 0
+    for batch in batches:
+        for lengths in (data.source_lengths[batch], data.target_lengths[batch]):
+            padded_tokens += len(batch) * lengths.max(initial=0)
+            real_tokens += lengths.sum()
 
+    return 1 - real_tokens / padded_tokens if padded_tokens else 0.0
+
+
+# Mean loss and number of target tokens of the batch, left on the device so that
+# the step does not wait for the gpu (see LossMeter)
+# With a TrainingProfiler the time of every stage of the step is recorded
+def training_step(
+    batch, model, tokenizer, optimizer, src_lang, tgt_lang, profiler=None
+):
+    stage = profiler.stage if profiler is not None else lambda name: nullcontext()
+
+    with torch.cuda.amp.autocast():
+        with stage("transfer"):
+            tokenized_batch = tokenize_batch(
+                model, batch, tokenizer, src_lang, tgt_lang
+            )
+        with stage("forward"):
+            loss = model(**tokenized_batch).loss
+
+        with stage("backward"):
+            loss.backward()
+        with stage("optimizer"):
+            optimizer.step()
+            optimizer.zero_grad()
+
+        return loss.detach(), (tokenized_batch["labels"] != -100).sum()
+
+
+# Peak resident memory of the process in bytes (ru_maxrss is in kilobytes on linux,
+# in bytes on macos), None where not available (windows)
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# Wall time of the training stages, real and padded tokens and peak memory per
+# (src_lang, tgt_lang) pair: gpu memory on the gpu, peak resident memory of the
+# process (since its start) on the cpu. Stages outside of a pair (tokenization of
+# the data, validation, checkpoint) are recorded under "all"; the transfer stage
+# of a step is the copy of the collated batch to the device. Gpu work is
+# asynchronous, so stage times are exact only with synchronize=True, which waits
+# for the gpu at the end of every stage
+class TrainingProfiler:
+    step_stages = ("data", "transfer", "forward", "backward", "optimizer")
+
+    def __init__(
+        self, log_path="training_profile.jsonl", synchronize=False, verbose=True
+    ):
+        self.log_path = log_path
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.verbose = verbose
+        self.pair = "all"
+        self.reset()
+
+    def reset(self):
+        # {pair: {stage: seconds}}
+        self.times = defaultdict(lambda: defaultdict(float))
+        # {pair: {"steps": ..., "real_tokens": ..., "padded_tokens": ...}}
+        self.counts = defaultdict(lambda: defaultdict(int))
+        self.peak_memory = defaultdict(int)
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, pair=None):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            self.times[pair or self.pair][name] += time.perf_counter() - start
+
+    # Iterate the (src_lang, tgt_lang, batch) items recording the wait for each
+    # batch as its data stage, its tokens and the peak memory of its step
+    def batches(self, items):
+        items = iter(items)
+        while True:
+            start = time.perf_counter()
+            item = next(items, None)
+            if item is None:
+                self.pair = "all"
+                return
+
+            src_lang, tgt_lang, batch = item
+            self.pair = f"{src_lang}-{tgt_lang}"
+            self.times[self.pair]["data"] += time.perf_counter() - start
+
+            counts = self.counts[self.pair]
+            counts["steps"] += 1
+            for name, mask in (
+                ("input_ids", batch["attention_mask"]),
+                ("labels", batch["labels"] != -100),
+            ):
+                counts["real_tokens"] += int(mask.sum())
+                counts["padded_tokens"] += batch[name].numel()
+
+            if torch.cuda.is_available():
+                torch.cuda.reset_peak_memory_stats()
+            yield item
+            peak_memory = (
+                torch.cuda.max_memory_allocated()
+                if torch.cuda.is_available()
+                else peak_rss()
+            )
+            if peak_memory is not None:
+                self.peak_memory[self.pair] = max(
+                    self.peak_memory[self.pair], peak_memory
+                )
+
+    # Append the record of the epoch to log_path, print its summary and reset
+    def end_epoch(self, epoch, total_steps):
+        pairs = {}
+        for pair, counts in self.counts.items():
+            step_time = sum(self.times[pair][name] for name in self.step_stages)
+            pairs[pair] = {
+                **counts,
+                "tokens_per_second": (
+                    counts["real_tokens"] / step_time if step_time else 0.0
+                ),
+                "padding": (
+                    1 - counts["real_tokens"] / counts["padded_tokens"]
+                    if counts["padded_tokens"]
+                    else 0.0
+                ),
+                "peak_memory_mb": (
+                    self.peak_memory[pair] / 2**20 if pair in self.peak_memory else None
+                ),
+            }
+
+        record = {
+            "epoch": epoch,
+            "total_steps": total_steps,
+            "wall_time": time.perf_counter() - self.start,
+            "stages": {pair: dict(times) for pair, times in self.times.items()},
+            "pairs": pairs,
+        }
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+
+        if self.verbose:
+            self.print_summary(record)
+
+        self.reset()
+
+    def print_summary(self, record):
+        pairs = record["pairs"]
+        print(
+            f"Epoch {record['epoch']}: {record['wall_time']:.1f}s, "
+            f"{record['total_steps']} total steps"
+        )
+        for pair, times in record["stages"].items():
+            stages = ", ".join(
+                f"{name} {seconds:.1f}s" for name, seconds in times.items()
+            )
+            if pair in pairs:
+                stats = pairs[pair]
+                memory = (
+                    f"peak {'gpu' if torch.cuda.is_available() else 'process'} "
+                    f"memory {stats['peak_memory_mb']:.0f} MB, "
+                    if stats["peak_memory_mb"] is not None
+                    else ""
+                )
+                print(
+                    f"  {pair}: {stats['steps']} steps, "
+                    f"{stats['tokens_per_second']:.0f} tokens/s, "
+                    f"padding {stats['padding']:.1%}, {memory}{stages}"
+                )
+            else:
+                print(f"  {pair}: {stages}")
+
+
+# Training losses per pair, summed on the device and read back once every
+# flush_steps steps or flush_seconds seconds. At each flush the mean loss per token
+# of every pair is logged in log_path (JSONL) and added to the smoothed losses
+class LossMeter:
+    def __init__(
+        self,
+        log_path="training_losses.jsonl",
+        flush_steps=50,
+        flush_seconds=30.0,
+        smoothing=0.9,
+    ):
+        self.log_path = log_path
+        self.flush_steps = flush_steps
+        self.flush_seconds = flush_seconds
+        self.smoothing = smoothing
+        # {(src_lang, tgt_lang): loss}
+        self.smoothed = {}
+        self.sums = {}
+        self.steps = 0
+        self.last_flush = time.monotonic()
+
+    # Add the loss of a step, return True if the losses were flushed
+    def add(self, pair, loss, tokens, total_steps):
+        loss_sum, token_sum = self.sums.get(pair, (0, 0))
+        self.sums[pair] = (loss_sum + loss.float() * tokens, token_sum + tokens)
+        self.steps += 1
+
+        if (
+            self.steps >= self.flush_steps
+            or time.monotonic() - self.last_flush >= self.flush_seconds
+        ):
+            self.flush(total_steps)
+            return True
+        return False
+
+    def flush(self, total_steps):
+        if not self.sums:
+            return
+
+        pairs = list(self.sums)
+        values = torch.stack(
+            [value.float() for pair in pairs for value in self.sums[pair]]
+        ).tolist()
+
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            for (src_lang, tgt_lang), loss_sum, tokens in zip(
+                pairs, values[::2], values[1::2]
+            ):
+                loss = loss_sum / tokens
+                previous = self.smoothed.get((src_lang, tgt_lang), loss)
+                self.smoothed[(src_lang, tgt_lang)] = (
+                    self.smoothing * previous + (1 - self.smoothing) * loss
+                )
+                record = {
+                    "total_steps": total_steps,
+                    "src_lang": src_lang,
+                    "tgt_lang": tgt_lang,
+                    "loss": loss,
+                    "smoothed_loss": self.smoothed[(src_lang, tgt_lang)],
+                    "tokens": int(tokens),
+                }
+                f.write(json.dumps(record) + "\n")
+
+        self.sums = {}
+        self.steps = 0
+        self.last_flush = time.monotonic()
+
+    # Smoothed losses for the progress bar
+    def postfix(self):
+        return {
+            f"{src_lang}-{tgt_lang}": f"{loss:.3f}"
+            for (src_lang, tgt_lang), loss in self.smoothed.items()
+        }
+
+
+# Mean loss and number of target tokens of the batch, left on the device
 def validation_step(batch, model, tokenizer, src_lang, tgt_lang):
     with torch.no_grad():
         with torch.cuda.amp.autocast():
@@ -710,4 +1392,372 @@ def validation_step(batch, model, tokenizer, src_lang, tgt_lang):
             )
             loss = model(**tokenized_batch).loss
 
-            return loss.item(), (tokenized_batch["labels"] != -100).sum().item()
+            return loss, (tokenized_batch["labels"] != -100).sum()
+
+
+# Validation over pre-collated, length-sorted batches of every pair.
+# Losses and tokens are summed on the device and synchronized once per evaluation.
+# The quick evaluation uses a fixed random subsample of quick_size examples per pair.
+# adapters ({(src_lang, tgt_lang): adapter}) selects the LoRA adapter of each pair
+class Evaluator:
+    def __init__(
+        self,
+        tokenized_data,
+        model,
+        tokenizer,
+        batch_size,
+        max_tokens=None,
+        quick_size=None,
+        seed=0,
+        adapters=None,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.adapters = adapters
+
+        rng = np.random.default_rng(seed)
+        self.batches = []
+        self.quick_batches = []
+        for (src_lang, tgt_lang), data in tokenized_data.items():
+            self.batches += [
+                (src_lang, tgt_lang, data.collate(batch))
+                for batch in cut_batches(
+                    data, length_order(data), batch_size, max_tokens
+                )
+            ]
+
+            if quick_size is not None:
+                subsample = rng.choice(
+                    len(data), min(quick_size, len(data)), replace=False
+                )
+                self.quick_batches += [
+                    (src_lang, tgt_lang, data.collate(batch))
+                    for batch in cut_batches(
+                        data, length_order(data, subsample), batch_size, max_tokens
+                    )
+                ]
+
+    # Total loss and number of tokens, on the quick subsample if requested
+    def evaluate(self, quick=False):
+        total_loss = torch.zeros((), device=self.model.device, dtype=torch.float64)
+        total_tokens = torch.zeros((), device=self.model.device, dtype=torch.float64)
+
+        for src_lang, tgt_lang, batch in self.quick_batches if quick else self.batches:
+            if self.adapters is not None:
+                set_lora_adapter(self.model, self.adapters[(src_lang, tgt_lang)])
+            loss, tokens = validation_step(
+                batch,
+                self.model,
+                self.tokenizer,
+                lang_to_m2m_lang_id[src_lang],
+                lang_to_m2m_lang_id[tgt_lang],
+            )
+            total_loss += loss * tokens
+            total_tokens += tokens
+
+        total_loss, total_tokens = torch.stack([total_loss, total_tokens]).tolist()
+        return total_loss, int(total_tokens)
+
+
+# Copy of tensors (also nested in dicts, lists and tuples) on the cpu, so that a
+# snapshot is not changed by the next training steps
+def cpu_copy(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: cpu_copy(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(value) for value in obj)
+    return obj
+
+
+# States of all the random generators, restored by set_rng_states
+def get_rng_states():
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_states(states):
+    random.setstate(states["python"])
+    np.random.set_state(states["numpy"])
+    torch.set_rng_state(states["torch"])
+    if states["cuda"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+# Checkpoints written by a background thread, one at a time: the model and the
+# optimizer are copied on the cpu when saving, the files are written while the
+# training goes on. save_best keeps the max_models last (best) models in
+# topk_models, save_state writes the full training state to resume from
+# With adapters_only the checkpoints hold only the LoRA adapters of the model
+# (see add_lora_adapters). The training config (e.g. languages, adapters, base
+# model) is saved with the state, which is only resumed by the same config
+class CheckpointManager:
+    def __init__(
+        self,
+        max_models=1,
+        state_path="training_state.pt",
+        adapters_only=False,
+        config=None,
+        max_pending=2,
+    ):
+        self.max_models = max_models
+        self.state_path = state_path
+        self.adapters_only = adapters_only
+        self.config = config
+        self.topk_models = []
+        self.executor = ThreadPoolExecutor(1)
+        # Checkpoints queued or being written, oldest first
+        self.pending = deque()
+        self.max_pending = max_pending
+
+    # Queue a checkpoint without waiting for the previous ones (the executor writes
+    # them one at a time). Only with max_pending checkpoints already queued, each
+    # holding a cpu copy of the model, the oldest is waited for. Errors of the
+    # written checkpoints are raised here
+    def _submit(self, function, *args):
+        while self.pending and (
+            self.pending[0].done() or len(self.pending) >= self.max_pending
+        ):
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(function, *args))
+
+    def wait(self):
+        while self.pending:
+            self.pending.popleft().result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+    def save_best(self, model, fname):
+        self.topk_models.append(fname)
+        removed = self.topk_models[: -self.max_models]
+        self.topk_models = self.topk_models[-self.max_models :]
+        self._submit(
+            self._write_best, model, cpu_copy(self._model_state(model)), fname, removed
+        )
+
+    def _model_state(self, model):
+        return lora_state_dict(model) if self.adapters_only else model.state_dict()
+
+    def _write_best(self, model, state_dict, fname, removed):
+        if self.adapters_only:
+            save_lora_adapters(fname, state_dict, model.lora_config)
+        else:
+            model.save_pretrained(fname, state_dict=state_dict)
+        for fname in removed:
+            shutil.rmtree(fname, ignore_errors=True)
+            print(f"Removing {fname}")
+
+    # state: total_steps, epoch, position in the epoch batches and anything else
+    # needed to resume the training, saved with model, optimizer and rng states
+    def save_state(self, model, optimizer, **state):
+        state = {
+            **state,
+            "config": self.config,
+            "model": cpu_copy(self._model_state(model)),
+            "optimizer": cpu_copy(optimizer.state_dict()),
+            "rng": get_rng_states(),
+            "topk_models": list(self.topk_models),
+        }
+        self._submit(self._write_state, state)
+
+    def _write_state(self, state):
+        # The old state is replaced only once the new one is complete
+        tmp_path = self.state_path + ".tmp"
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, self.state_path)
+
+    # Restore model, optimizer and rng states from the latest saved state and
+    # return the rest of it, None if there is no state to resume from. The state
+    # of another config or of a finished training is refused
+    def load_state(self, model, optimizer):
+        if not os.path.exists(self.state_path):
+            return None
+
+        state = torch.load(self.state_path, map_location="cpu", weights_only=False)
+        if state.get("config") != self.config:
+            raise ValueError(
+                f"{self.state_path} was saved with config {state.get('config')}, "
+                f"not {self.config}: delete it or train without resuming"
+            )
+        if state.get("finished", False):
+            raise ValueError(
+                f"{self.state_path} is the state of a finished training: delete it "
+                "or train without resuming"
+            )
+        model.load_state_dict(state.pop("model"), strict=not self.adapters_only)
+        optimizer.load_state_dict(state.pop("optimizer"))
+        set_rng_states(state.pop("rng"))
+        self.topk_models = state.pop("topk_models")
+
+        return state
+
+
+# Rank, local rank and number of processes of a data-parallel training launched by
+# torchrun (e.g. torchrun --nproc_per_node=4 train.py), a single process otherwise
+def init_distributed(backend="gloo"):
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group(backend)
+
+    return (
+        int(os.environ.get("RANK", 0)),
+        int(os.environ.get("LOCAL_RANK", 0)),
+        world_size,
+    )
+
+
+# The object of rank src, sent to all the processes
+def broadcast_object(obj, src=0):
+    if not dist.is_initialized():
+        return obj
+
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+# Disjoint shard of the batches for a rank: every rank gets the same number of
+# batches (all of them take part in every gradient all-reduce), so up to
+# world_size - 1 batches are left out
+def shard_batches(batches, rank, world_size):
+    return batches[rank::world_size][: len(batches) // world_size]
+
+
+# Log file of a rank: rank 0 writes to path, the others to path.rank<rank>
+def rank_path(path, rank):
+    if rank == 0:
+        return path
+
+    root, ext = os.path.splitext(path)
+    return f"{root}.rank{rank}{ext}"
+
+
+# Linear layer with LoRA adapters: the frozen base layer plus, for the active
+# adapter, the low-rank update B @ A scaled by alpha / rank. B starts at zero, so a
+# new adapter does not change the output of the model
+class LoRALinear(torch.nn.Module):
+    def __init__(self, base, adapters, rank=8, alpha=16, dropout=0.0):
+        super().__init__()
+        self.base = base
+        self.scaling = alpha / rank
+        self.dropout = torch.nn.Dropout(dropout)
+        self.active = None
+
+        self.lora_A = torch.nn.ParameterDict()
+        self.lora_B = torch.nn.ParameterDict()
+        for adapter in adapters:
+            lora_A = torch.empty(rank, base.in_features, device=base.weight.device)
+            torch.nn.init.kaiming_uniform_(lora_A, a=5**0.5)
+            self.lora_A[adapter] = torch.nn.Parameter(lora_A)
+            self.lora_B[adapter] = torch.nn.Parameter(
+                torch.zeros(base.out_features, rank, device=base.weight.device)
+            )
+
+    def forward(self, x):
+        output = self.base(x)
+        if self.active is None:
+            return output
+
+        lora_A, lora_B = self.lora_A[self.active], self.lora_B[self.active]
+        return output + self.dropout(x) @ lora_A.T @ lora_B.T * self.scaling
+
+    # The base layer with the update of the adapter folded into its weight
+    def merged(self, adapter):
+        with torch.no_grad():
+            self.base.weight += (
+                self.lora_B[adapter] @ self.lora_A[adapter] * self.scaling
+            )
+        return self.base
+
+
+# Attention and feed-forward projections of the M2M100 layers
+lora_targets = ("q_proj", "k_proj", "v_proj", "out_proj", "fc1", "fc2")
+
+
+# Replace the target linear layers of the model with LoRA layers holding the given
+# adapters (e.g. one per language pair) and freeze everything but the adapters
+def add_lora_adapters(
+    model, adapters, rank=8, alpha=16, dropout=0.0, targets=lora_targets
+):
+    model.requires_grad_(False)
+
+    for name, module in list(model.named_modules()):
+        for child_name, child in module.named_children():
+            if child_name in targets and isinstance(child, torch.nn.Linear):
+                setattr(
+                    module,
+                    child_name,
+                    LoRALinear(child, adapters, rank, alpha, dropout),
+                )
+
+    # Saved with the adapters, to rebuild the model when merging them
+    model.lora_config = {
+        "base_model": model.name_or_path,
+        "adapters": list(adapters),
+        "rank": rank,
+        "alpha": alpha,
+        "targets": list(targets),
+    }
+    return model
+
+
+# Adapter used by all the LoRA layers, None for the base model
+def set_lora_adapter(model, adapter):
+    for module in model.modules():
+        if isinstance(module, LoRALinear):
+            module.active = adapter
+
+
+def lora_state_dict(model):
+    return {
+        name: tensor
+        for name, tensor in model.state_dict().items()
+        if ".lora_A." in name or ".lora_B." in name
+    }
+
+
+def save_lora_adapters(path, state_dict, config):
+    os.makedirs(path, exist_ok=True)
+    torch.save(state_dict, os.path.join(path, "adapters.pt"))
+    with open(os.path.join(path, "adapter_config.json"), "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)
+
+
+# The base model with the saved adapters
+def load_lora_adapters(path, model_class, device="cpu"):
+    with open(os.path.join(path, "adapter_config.json"), encoding="utf-8") as f:
+        config = json.load(f)
+
+    model = model_class.from_pretrained(config["base_model"]).to(device)
+    add_lora_adapters(
+        model,
+        config["adapters"],
+        config["rank"],
+        config["alpha"],
+        targets=config["targets"],
+    )
+    state_dict = torch.load(os.path.join(path, "adapters.pt"), map_location=device)
+    unexpected_keys = model.load_state_dict(state_dict, strict=False).unexpected_keys
+    if unexpected_keys:
+        raise ValueError(f"Adapters not matching the model: {unexpected_keys[:5]}")
+    return model
+
+
+# Fold an adapter into the weights of the model, which goes back to the plain
+# architecture of the base model and can be saved with save_pretrained
+def merge_lora_adapter(model, adapter):
+    for name, module in list(model.named_modules()):
+        for child_name, child in module.named_children():
+            if isinstance(child, LoRALinear):
+                setattr(module, child_name, child.merged(adapter))
+
+    model.requires_grad_(True)
+    del model.lora_config
+    return model